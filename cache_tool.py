@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+# IDS Project 2020
+# Inspect and prune the URL cache
+
+from lib.cache import main
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,58 @@ class Configuration:
 
 config = Configuration({
     'DEBUG': True,
+    # Rendered energy history charts kept in server memory
+    'PNG_CACHE_ENTRIES': 256,
+    'PNG_CACHE_BYTES': 32 * 1024 * 1024,
+    # Browser/proxy cache lifetime for charts (seconds); ETag handles revalidation
+    'PNG_MAX_AGE': 3600,
+    # Same for the property list; only changes when the data store is refreshed
+    'PROPERTIES_MAX_AGE': 24 * 3600,
+    # Seconds between checks for a new data store generation in the server
+    'DATASTORE_POLL_INTERVAL': 10,
+    # Watch for new generations from server start; the preforking server starts
+    # watching in each worker instead (see gunicorn.conf.py)
+    'DATASTORE_WATCH': True,
+    # Charts rendered at once on the host (by all server processes together),
+    # and seconds a request waits for a chart
+    'RENDER_WORKERS': 2,
+    'RENDER_TIMEOUT': 60,
+    # Request threads per preforked server worker
+    'SERVER_THREADS': 4,
+    # Request threads of a server process that may wait for a chart render at once
+    # (fewer than SERVER_THREADS, so that the other requests always get through)
+    'RENDER_WAITERS': 2,
+    # Map queries: cluster grid cell size in screen pixels, and most buildings per nearest query
+    'CLUSTER_CELL_SIZE': 64,
+    'NEAREST_MAX': 100,
+    # Concurrent fetching from the original data sources
+    'FETCH_WORKERS': 8,
+    'FETCH_HOST_INTERVAL': 0.05, # Minimum seconds between request starts per host
+    'FETCH_RETRIES': 3,
+    'FETCH_BACKOFF': 1.0,        # Seconds, doubled on each retry
+    # Keep-alive connections kept per host, and socket timeout in seconds
+    'HTTP_POOL_SIZE': 8,
+    'HTTP_TIMEOUT': 60,
+    # On-disk URL cache size budget; least recently used objects are evicted beyond it
+    'CACHE_MAX_BYTES': 2 * 1024 ** 3,
+    # Download buffer size
+    'CACHE_BUF_SIZE': 1024 * 1024,
+    # Store text (JSON, XML..) responses gzip compressed
+    'CACHE_COMPRESS': True,
+    # Process pool jobs (image processing, chart rendering)
+    'JOB_RETRIES': 2,
+    'SEASONAL_IMAGE_MEMORY': 256 * 1024 ** 2, # Peak bytes per decoded image, bounds the workers
+    'SEASONAL_IMAGE_TIMEOUT': 300,            # Seconds, includes the download
+    # Energy data fetched for each building (the heating models only use Heat),
+    # and full calendar years of history
+    'ENERGY_REPORTING_GROUPS': ['Heat'],
+    'ENERGY_YEARS': 10,
+    # Time to live (seconds) of cached URLs: first matching (regex, ttl), None = forever.
+    # Expired objects are revalidated with the server, unmodified ones are not re-downloaded.
+    'CACHE_TTL': [
+        (r'/SeasonalForecast/T2m_index\.txt$', 24 * 3600),
+        (r'/api/v1\.0/Property/List$', 7 * 24 * 3600),
+    ],
 })
 
 # TODO: Read/Write config file if deemed necessary
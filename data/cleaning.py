@@ -0,0 +1,64 @@
+import pandas as pd
+import numpy as np
+
+# Points at least this many standard deviations (or robust z-scores) away are outliers
+OUTLIER_LIMIT = 6
+# Outliers are removed iteratively, because some outliers are so big they make other
+# outliers look normal. Usually converges in a couple of rounds.
+MAX_ROUNDS = 20
+
+def group_median(codes, values, ngroups):
+    """
+    Median of values for each group code 0..ngroups-1 (NaN for empty groups)
+    """
+    order = np.lexsort((values, codes))
+    values = values[order]
+    counts = np.bincount(codes, minlength = ngroups)
+    starts = np.cumsum(counts) - counts
+    median = np.full(ngroups, np.nan)
+    has = counts > 0
+    lo = starts[has] + (counts[has] - 1) // 2
+    hi = starts[has] + counts[has] // 2
+    median[has] = (values[lo] + values[hi]) / 2
+    return median
+
+def zscores(codes, values, keep, ngroups, robust = False):
+    """
+    Z-scores of values within their groups, computed over the values in keep.
+    robust: Use the median and MAD (scaled to match the standard deviation of normally
+    distributed data) instead of the mean and standard deviation.
+    Groups without spread get NaN scores, like scipy.stats.zscore.
+    """
+    if robust:
+        center = group_median(codes[keep], values[keep], ngroups)
+        spread = group_median(codes[keep], np.abs(values - center[codes])[keep], ngroups) / 0.6745
+    else:
+        n = np.bincount(codes, weights = keep, minlength = ngroups)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            center = np.bincount(codes, weights = np.where(keep, values, 0), minlength = ngroups) / n
+            deviation = np.where(keep, values - center[codes], 0)
+            spread = np.sqrt(np.bincount(codes, weights = deviation ** 2, minlength = ngroups) / n)
+    spread[spread == 0] = np.nan
+    return (values - center[codes]) / spread[codes]
+
+def reject_outliers(df, by = 'building', column = 'value', limit = OUTLIER_LIMIT, robust = False):
+    """
+    Remove outliers of column from all groups of df (long format, grouped by column by)
+    at once, repeating until no outliers remain.
+    robust: Use median/MAD based z-scores, see zscores
+    Returns (df without the outliers, number of rejected points per group)
+    """
+    (codes, groups) = pd.factorize(df[by])
+    values = df[column].values.astype(float)
+    # Missing values are ignored, not rejected
+    keep = ~np.isnan(values)
+    valid = keep.copy()
+    for _ in range(MAX_ROUNDS):
+        with np.errstate(invalid = 'ignore'):
+            outliers = keep & (np.abs(zscores(codes, values, keep, len(groups), robust)) >= limit)
+        if not outliers.any():
+            break
+        keep &= ~outliers
+    rejected = valid & ~keep
+    counts = pd.Series(np.bincount(codes[rejected], minlength = len(groups)), index = groups, name = 'rejected')
+    return (df[keep | ~valid], counts)
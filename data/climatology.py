@@ -0,0 +1,46 @@
+import pandas as pd
+import numpy as np
+
+# Percentiles included in climatologies
+PERCENTILES = [10, 50, 90]
+# Rolling climatology windows (years) stored by fetch_data
+CLIMATE_WINDOWS = [10, 30]
+
+def monthly_means(df):
+    """
+    Monthly means of a daily time series table (one column per station), indexed by
+    the first day of each month.
+    """
+    df = df.copy()
+    df.index = pd.to_datetime(df.index)
+    return df.resample('MS').mean()
+
+def climatology(df, years = None, percentiles = PERCENTILES):
+    """
+    Monthly climatology of each column (station) in df, a time series table of any
+    frequency (daily, monthly..).
+    years: Only use the last years of data (counting back from the latest date)
+    Returns a DataFrame indexed by station with columns month (1-12), count, mean, std
+    and p<N> for each of percentiles.
+    """
+    df = df.copy()
+    df.index = pd.to_datetime(df.index)
+    if years is not None and len(df):
+        df = df[df.index > df.index.max() - pd.DateOffset(years = years)]
+    # Long format: one row per (date, station)
+    long = df.rename_axis(index = 'date', columns = 'station').stack().rename('value').reset_index()
+    grouped = long.groupby(['station', long.date.dt.month.rename('month')]).value
+    stats = grouped.agg(['count', 'mean', 'std'])
+    quantiles = grouped.quantile(np.array(percentiles) / 100).unstack()
+    quantiles.columns = [ f'p{p}' for p in percentiles ]
+    return pd.concat([stats, quantiles], axis = 1).reset_index(level = 'month')
+
+def rolling_climatologies(df, windows = CLIMATE_WINDOWS):
+    """
+    Climatologies of df for the last windows years (None meaning all data), combined into
+    one table with the window in column 'years' (0 for all data).
+    """
+    return pd.concat([
+        climatology(df, years).assign(years = years or 0)
+        for years in windows
+    ])
@@ -0,0 +1,120 @@
+import threading
+import json
+import time
+
+try:
+    from lib import debug, config
+    from lib.lru import LRUCache
+    from lib.spatial import SpatialIndex
+    from lib.payload import Payload
+    from data.wrangler import get_data, datastore_fingerprint, read_generation, write_generation, load_chart_manifest, migrate_heat_series
+    from data.energy import Prognoses, HeatSeries
+except ModuleNotFoundError:
+    from ..lib import debug, config
+    from ..lib.lru import LRUCache
+    from ..lib.spatial import SpatialIndex
+    from ..lib.payload import Payload
+    from ..data.wrangler import get_data, datastore_fingerprint, read_generation, write_generation, load_chart_manifest, migrate_heat_series
+    from ..data.energy import Prognoses, HeatSeries
+
+class Snapshot:
+    """
+    Everything the server needs from one generation of the data store: the data sets
+    and everything derived from them. Never modified once loaded (except for the chart
+    cache), so requests can use a snapshot without locking.
+    read_only: Don't write to the data store (migrations, column stores). Loading several
+               server processes at once must not have them writing the same files.
+    """
+    def __init__(self, generation, read_only = False):
+        self.generation = generation
+        if not read_only:
+            migrate_heat_series()
+        # Digest of the file names, sizes and modification times (not the contents), for
+        # ETags that survive reloads of data sets fetch_data didn't rewrite
+        self.fingerprint = datastore_fingerprint()
+        data = lambda name: get_data(name, read_only)
+        self.buildings = data('heated_buildings').or_fail()
+        self.heat_series = HeatSeries(data('heat_series').or_fail())
+        self.temperatures = data('decade_temperatures').or_fail()
+        self.avgtemp = data('avg_temperatures').or_fail()
+        self.anomalities = data('seasonal_anomalities').or_fail()
+        self.prognoses = Prognoses(self.buildings, self.avgtemp, self.anomalities)
+        b = self.buildings
+        self.spatial_index = SpatialIndex(b.latitude.values, b.longitude.values)
+        # JSON of each building as in /api/properties, for composing responses of any subset
+        self.property_json = [
+            json.dumps({ 'propertyName': name, 'latitude': lat, 'longitude': lng })
+            for (name, lat, lng) in zip(b.propertyName, b.latitude, b.longitude)
+        ]
+        # /api/properties never changes within a snapshot, encode it once
+        self.properties_payload = Payload(('{' + ','.join(
+            f'{json.dumps(code)}:{js}' for (code, js) in zip(b.index, self.property_json)) + '}').encode())
+        # Charts pre-rendered by fetch_data.py --render-charts, if they match the store
+        manifest = load_chart_manifest()
+        self.prerendered = set(manifest['charts']) if manifest['fingerprint'] == self.fingerprint else set()
+        # Rendered charts, dropped along with the snapshot
+        self.png_cache = LRUCache(config.PNG_CACHE_ENTRIES, config.PNG_CACHE_BYTES)
+
+class DatastoreManager:
+    """
+    Holds the current Snapshot of the data store, and replaces it with a new one
+    when fetch_data has written a new generation (see wrangler.read_generation).
+    Only the initial load writes to the store (see Snapshot); new generations come
+    from fetch_data complete with their column stores, and are loaded read-only.
+    usage:
+    - datastore = DatastoreManager()  # Loads the current generation
+    - datastore.start()               # Watch for new generations in a background thread
+    - snapshot = datastore.current    # Once per request, for a consistent view
+    """
+    def __init__(self, poll_interval = None):
+        self.poll_interval = config.DATASTORE_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.current = Snapshot(read_generation() or self._initial_generation())
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _initial_generation():
+        # Stores last written before generations existed; the files as they are now
+        # are the first generation, later ones only come from fetch_data when complete
+        try:
+            return write_generation()
+        except OSError as e:
+            debug(f'Could not write the data store generation: {e}')
+            return None
+
+    def reload(self):
+        """
+        Load the current generation if it's new. A failing load keeps the old snapshot,
+        and is tried again on the next call. Returns whether the snapshot was replaced.
+        """
+        with self._lock:
+            generation = read_generation()
+            if generation is None or generation == self.current.generation:
+                return False
+            start = time.perf_counter()
+            try:
+                snapshot = Snapshot(generation, read_only = True)
+            except Exception as e:
+                debug(f'Loading data store generation {generation} failed: {e!r}')
+                return False
+            # Requests in progress keep using the snapshot they started with
+            self.current = snapshot
+            debug(f'Loaded data store generation {generation} in {time.perf_counter() - start:.1f} s')
+            return True
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.reload()
+            except Exception as e:
+                # Keep watching whatever happens
+                debug(f'Data store watch failed: {e!r}')
+
+    def start(self):
+        """
+        Start watching for new generations (in this process)
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target = self._watch, name = 'datastore-watch', daemon = True)
+            self._thread.start()
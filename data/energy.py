@@ -1,33 +1,27 @@
 import pandas as pd
 import numpy as np
 import urllib.parse as urlparse
-from scipy import stats
-from sklearn import linear_model
 import datetime
-import pickle
-import base64
+import json
 
 try:
-    from lib import open_url, debug
-    from data.seasonal_anomalities import anomalities_for
-    from lib.util import month_range
+    from lib import open_url, debug, config
+    from lib.fetch import parallel_map
+    from data.cleaning import reject_outliers
+    from lib.util import month_range, month_periods, period_dates
 except ModuleNotFoundError:
-    from ..lib import open_url, debug
-    from ..data.seasonal_anomalities import anomalities_for
-    from ..lib.util import month_range
+    from ..lib import open_url, debug, config
+    from ..lib.fetch import parallel_map
+    from ..data.cleaning import reject_outliers
+    from ..lib.util import month_range, month_periods, period_dates
 
 ENERGY_RESOURCE = 'https://helsinki-openapi.nuuka.cloud/api/v1.0/EnergyData/Monthly/ListByProperty'
 VALID_REPORTING_GROUPS = ['Electricity', 'Heat', 'Water', 'DistrictCooling']
-def get_monthly_energy_data(buildingCode, reporting_group, start_time, end_time):
-  """
-  Reporting groups: 'Electricity', 'Heat', 'Water', 'DistrictCooling'
-  throws: HTTPError if resource does not exist
-  """
-
+# Offset added before taking log of heat values, to fix log(0)
+LOG_OFFSET = 3
+def energy_url(buildingCode, reporting_group, start_time, end_time):
   if not reporting_group in VALID_REPORTING_GROUPS:
       raise ValueError(f'reporting_group should be one of {" ".join(VALID_REPORTING_GROUPS)}')
-  resource = 'https://helsinki-openapi.nuuka.cloud/api/v1.0/EnergyData/Monthly/ListByProperty?Record=LocationName'
-
   params = urlparse.urlencode(
       { 'Record': 'BuildingCode',
         'SearchString': buildingCode,
@@ -35,108 +29,305 @@ def get_monthly_energy_data(buildingCode, reporting_group, start_time, end_time)
         'StartTime': start_time,
         'EndTime': end_time
       })
-  search_url = f'{ENERGY_RESOURCE}?{params}'
-  debug(f'Requesting {search_url}')
-  ret = pd.read_json(open_url(search_url))
-  return ret
+  return f'{ENERGY_RESOURCE}?{params}'
 
-def get_decade_heat_data(buildingCode):
+def fetch_energy_years(t):
     """
-    Get 10 years of heat data for building.
+    Monthly energy data of a building and reporting group for calendar years first..last.
+    Returns (months, values) as NumPy arrays, months as integer periods.
     throws: HTTPError if resource does not exist
     """
-    # Begin fetching from last month
-    d = datetime.date.today()
-    lastmonth = d - datetime.timedelta(days = d.day - 1)
-    data = get_monthly_energy_data(buildingCode,
-                                   'Heat',
-                                   f'{lastmonth.year - 10}-{lastmonth.month}-01',
-                                   lastmonth.strftime('%Y-%m-%d')) # Unsure if ranges are inclusive or exclusive
-    data["date"] = pd.to_datetime(data["timestamp"])
-    #Set data for each month to be listed on first day of the month
-    data["date"] = pd.to_datetime(data["date"].apply(lambda x: x.strftime('%Y-%m')))
-    data.set_index("date", inplace=True)
-    data.drop(["timestamp", "reportingGroup", "locationName", "unit"], axis=1, inplace=True)
-    #Drop extreme outliers. We need might need to loop a few times, because some outliers are so big they make other outliers look normal 
-    while (np.abs(stats.zscore(data)) >= 6).any():
-        data = data[(np.abs(stats.zscore(data)) < 6).all(axis=1)]
-    return data
-
-def generate_heating_models(properties_df, temp_df):
-
-    def make_model(row):
+    (building, group, first, last) = t
+    # Whole years keep the URL, and so the cached response, the same from month to month.
+    # Only revalidate years that may still get new data (December arrives in January).
+    recent = (datetime.date.today() - datetime.timedelta(days = 31)).year
+    url = energy_url(building, group, f'{first}-01-01', f'{last}-12-31')
+    with open_url(url, update = last >= recent) as fh:
+        records = json.load(fh)
+    # Timestamps are local time, the month is all we need
+    months = np.array([ r['timestamp'][:7] for r in records ], dtype = 'datetime64[M]').astype(np.int64)
+    values = np.array([ np.nan if r['value'] is None else r['value'] for r in records ], dtype = float)
+    return (months, values)
+
+def energy_jobs(building, group, start, this_year):
+    """
+    Requests (building, group, first, last) covering the years start..this_year: the
+    closed years in one range, the previous and the current year each on their own.
+    """
+    jobs = []
+    if start < this_year - 1:
+        jobs.append((building, group, start, this_year - 2))
+    return jobs + [ (building, group, year, year) for year in range(max(start, this_year - 1), this_year + 1) ]
+
+def energy_series_table(buildings, groups, months, values):
+    """
+    Typed energy series table with columns building, group (categorical), month
+    (see lib.util.month_periods) and value, sorted by building, group and month.
+    """
+    df = pd.DataFrame({
+        'building': pd.Series(buildings, dtype = object),
+        'group': pd.Categorical(groups, categories = VALID_REPORTING_GROUPS),
+        'month': np.asarray(months, dtype = np.int64),
+        'value': np.asarray(values, dtype = float),
+    })
+    df = df.drop_duplicates(['building', 'group', 'month'], keep = 'last')
+    return df.sort_values(['building', 'group', 'month'], kind = 'mergesort').reset_index(drop = True)
+
+def get_energy_series(buildings, groups = None, previous = None):
+    """
+    Fetch the monthly energy data of buildings for reporting groups, all buildings
+    and groups concurrently (see energy_jobs).
+    groups: Reporting groups (default: config.ENERGY_REPORTING_GROUPS)
+    previous: Earlier result to update. Only the months since the last stored month of
+              each building and group are fetched and merged in; buildings not in
+              previous get their full history (config.ENERGY_YEARS).
+    Returns an energy series table, see energy_series_table.
+    """
+    groups = config.ENERGY_REPORTING_GROUPS if groups is None else groups
+    this_year = datetime.date.today().year
+    first_year = this_year - config.ENERGY_YEARS
+    last_year = {}
+    if previous is not None and len(previous):
+        latest = previous.groupby(['building', previous.group.astype(str)]).month.max()
+        last_year = { key: int(str(m)[:4]) for (key, m) in zip(latest.index, period_dates(latest.values)) }
+        known = set(previous.building)
+    else:
+        previous = None
+        known = set()
+    jobs = []
+    for building in buildings:
+        for group in groups:
+            # A building known without this group only has a chance of new data
+            start = last_year.get((building, group), this_year if building in known else first_year)
+            jobs += energy_jobs(building, group, start, this_year)
+    debug(f'Fetching energy data in {len(jobs)} requests')
+
+    (b, g, m, v) = ([], [], [], [])
+    for ((building, group, _, _), data, err) in parallel_map(fetch_energy_years, jobs):
+        if isinstance(err, IOError):
+            # No data for the building, group or year
+            continue
+        elif err:
+            raise err
+        (months, values) = data
+        # A month missing its value now doesn't replace a stored one
+        found = ~np.isnan(values)
+        (months, values) = (months[found], values[found])
+        b.append(np.full(len(months), building, dtype = object))
+        g.append(np.full(len(months), group, dtype = object))
+        m.append(months)
+        v.append(values)
+    if previous is not None:
+        # Fetched months replace the stored ones, they may have been corrected
+        b.insert(0, previous.building.values.astype(object))
+        g.insert(0, previous.group.values.astype(str).astype(object))
+        m.insert(0, previous.month.values)
+        v.insert(0, previous.value.values)
+    concat = lambda parts, dtype: np.concatenate(parts) if parts else np.array([], dtype = dtype)
+    df = energy_series_table(concat(b, object), concat(g, object), concat(m, np.int64), concat(v, float))
+    return df.dropna(subset = ['value']).reset_index(drop = True)
+
+def fit_linear(X, Y, mask):
+    """
+    Least squares fit of Y = coef * X + intercept for each row of Y (B x M) against X
+    (B x M or M), using only the points in mask. Returns (coef, intercept, R^2) arrays.
+    """
+    n = mask.sum(axis = 1)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean_x = np.where(mask, X, 0).sum(axis = 1) / n
+        mean_y = np.where(mask, Y, 0).sum(axis = 1) / n
+        dx = np.where(mask, X - mean_x[:, None], 0)
+        dy = np.where(mask, Y - mean_y[:, None], 0)
+        sxx = (dx ** 2).sum(axis = 1)
+        sxy = (dx * dy).sum(axis = 1)
+        syy = (dy ** 2).sum(axis = 1)
+        # Constant X can't explain anything (the minimum norm solution, like lstsq)
+        coef = np.where(sxx > 0, sxy / sxx, 0)
+        intercept = mean_y - coef * mean_x
+        ss_res = np.maximum(syy - coef * sxy, 0)
+        # Same convention as sklearn's r2_score for constant Y
+        score = np.where(syy > 0, 1 - ss_res / syy, np.where(ss_res > 0, 0, 1))
+    score[n == 0] = np.nan
+    return (coef, intercept, score)
+
+def fit_heating_models(heat, temps):
+    """
+    Fit the linear and log heating models for buildings at once.
+    heat: B x M matrix of monthly heat usage (NaN where missing)
+    temps: Average temperatures of the M months
+    Returns a DataFrame with the model parameters and scores (one row per building).
+    """
+    temps = np.asarray(temps, dtype = float)
+    mask = ~np.isnan(heat) & ~np.isnan(temps)[None, :]
+    (lin_coef, lin_intercept, lin_score) = fit_linear(temps, heat, mask)
+    #Add a tiny amount to fix log(0)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        log_heat = np.log(heat + LOG_OFFSET)
+    (log_coef, log_intercept, log_score) = fit_linear(temps, log_heat, mask & np.isfinite(log_heat))
+    datapoints = mask.sum(axis = 1).astype(float)
+    # No data, no model
+    datapoints[datapoints == 0] = np.nan
+    return pd.DataFrame({
+        'datapoints':    datapoints,
+        'lin_score':     lin_score,
+        'lin_coef':      lin_coef,
+        'lin_intercept': lin_intercept,
+        'log_score':     log_score,
+        'log_coef':      log_coef,
+        'log_intercept': log_intercept,
+    })
+
+def heat_series_table(heat_data):
+    """
+    Combine the heat data of buildings (dict building -> Series indexed by date) into
+    one long table with columns building, month (see lib.util.month_periods) and value,
+    sorted by building and month.
+    """
+    frames = [
+        pd.DataFrame({ 'building': building, 'month': month_periods(s.index), 'value': s.values })
+        for (building, s) in heat_data.items()
+    ]
+    if not frames:
+        return pd.DataFrame({ 'building': [], 'month': np.array([], dtype = np.int64), 'value': [] })
+    df = pd.concat(frames, ignore_index = True).dropna(subset = ['value'])
+    df = df.drop_duplicates(['building', 'month'], keep = 'last')
+    return df.sort_values(['building', 'month'], kind = 'mergesort').reset_index(drop = True)
+
+def heat_series_from_columns(models_df):
+    """
+    Extract the long heat series table from a heating model table that still has
+    the heat data in one column per month (YYYY-MM-dd), as stored by older versions.
+    Returns (models_df without the month columns, heat series table).
+    """
+    columns = models_df.columns[models_df.columns.str.match(r'^\d{4}-\d{2}-\d{2}$')]
+    wide = models_df[columns]
+    heat_data = { building: row.dropna().rename(index = pd.Timestamp) for (building, row) in wide.iterrows() }
+    return (models_df.drop(columns = columns), heat_series_table(heat_data))
+
+def get_heat_series(energy_df):
+    """
+    Heat series table (see heat_series_table) of an energy series table (see
+    get_energy_series), with extreme outliers dropped (see data.cleaning.reject_outliers).
+    """
+    heat = energy_df[energy_df.group.astype(str) == 'Heat']
+    (series_df, rejected) = reject_outliers(heat[['building', 'month', 'value']])
+    for (building, n) in rejected[rejected > 0].items():
+        debug(f'{building}: dropped {n} outliers')
+    return series_df.reset_index(drop = True)
+
+class HeatSeries:
+    """
+    Monthly heat usage of all buildings, backed by the long heat series table.
+    usage:
+    - series = HeatSeries(get_data('heat_series').or_fail())
+    - (months, values) = series.for_building('091-001-0001-0001')
+    """
+    def __init__(self, series_df):
+        buildings = series_df.building.values
+        if len(buildings) and (buildings[1:] < buildings[:-1]).any():
+            series_df = series_df.sort_values(['building', 'month'], kind = 'mergesort')
+            buildings = series_df.building.values
+        self.months = series_df.month.values
+        self.values = series_df.value.values
+        # Rows of each building are contiguous, remember where they start and end
+        starts = np.r_[0, np.flatnonzero(buildings[1:] != buildings[:-1]) + 1] if len(buildings) else []
+        ends = np.r_[starts[1:], len(buildings)] if len(buildings) else []
+        self._slices = { buildings[s]: (s, e) for (s, e) in zip(starts, ends) }
+
+    def __contains__(self, building):
+        return building in self._slices
+
+    def for_building(self, building):
         """
-        Construct model(s) for building at row
+        Returns (months, values) of building as NumPy arrays (views into the table),
+        months as integer periods (see lib.util.month_periods).
         """
-        building = row.name # Indexing by buildingName
-        try:
-            building_heat_df = get_decade_heat_data(building)
-        except IOError as e:
-            # Building has no heating data
-            debug(f'{building} lacks data')
-            return None
-        # Record starting & stop date
-        # these can then be used for example with df.columns.get_loc(row['heating_start'])
-        # to get the column indexes that contain data or just calculate the dates manually
-        heating_start = str(building_heat_df.iloc[0].name)[:10]
-        heating_stop  = str(building_heat_df.iloc[-1].name)[:10]
-        #Merge df:s to make inner join
-        building_df = pd.merge(building_heat_df,
-                               temp_df["avg_temp"],
-                               left_index=True,
-                               right_index=True)
-        building_df.dropna(inplace = True)
-        if not building_df.shape[0]:
-            # No data
-            return None
-        lin_m = linear_model.LinearRegression()
-        log_m = linear_model.LinearRegression()
-
-        X = building_df["avg_temp"].values.reshape(-1, 1)
-        lin_Y = building_df["value"].values.reshape(-1, 1)
-        #Add a tiny amount to fix log(0)
-        log_Y = np.log(lin_Y + 3)
-
-        lin_m.fit(X, lin_Y)
-        log_m.fit(X, log_Y)
-        d = {
-            'datapoints':    building_df.shape[0],
-            'lin_score':     lin_m.score(X, lin_Y),
-            'lin_coef':      lin_m.coef_[0][0],
-            'lin_intercept': lin_m.intercept_[0],
-            'lin_model':     base64.b64encode(pickle.dumps(lin_m)).decode(), # Need to keep as regular str
-            'log_score':     log_m.score(X, log_Y),
-            'log_coef':      log_m.coef_[0][0],
-            'log_intercept': log_m.intercept_[0],
-            'log_model':     base64.b64encode(pickle.dumps(log_m)).decode(),
-            'heating_start': heating_start,
-            'heating_stop':  heating_stop,
-        }
-        # Add the monthly heating data
-        for i, v in building_heat_df.iterrows():
-            d[str(i)[:10]] = v.value
-        return pd.Series(d)
-
-    return properties_df.apply(make_model, axis=1)
-
-def unthaw(s):
-    return pickle.loads(base64.b64decode(s))
+        (start, end) = self._slices.get(building, (0, 0))
+        return (self.months[start:end], self.values[start:end])
+
+def generate_heating_models(properties_df, temp_df, series_df = None):
+    """
+    Fit heating models for all buildings in properties_df.
+    series_df: Heat series table (see heat_series_table), fetched if not given
+    """
+    if series_df is None:
+        series_df = get_heat_series(get_energy_series(properties_df.index, ['Heat']))
+    if not len(series_df):
+        return pd.DataFrame(index = properties_df.index, columns = ['datapoints'], dtype = float)
+
+    # Months x buildings, aligned on month
+    heat_df = series_df.pivot(index = 'month', columns = 'building', values = 'value')
+    temps = temp_df["avg_temp"].copy()
+    temps.index = month_periods(pd.to_datetime(temps.index))
+    models = fit_heating_models(heat_df.values.T, temps.reindex(heat_df.index).values)
+    models.index = heat_df.columns
+    # Record starting & stop date of the heat data
+    months = series_df.groupby('building').month
+    models['heating_start'] = period_dates(months.min().reindex(models.index).values)
+    models['heating_stop'] = period_dates(months.max().reindex(models.index).values)
+    return models.reindex(properties_df.index)
+
+def predicted_temperatures(avg_df, anomalities_df, index = -1):
+    """
+    Returns the months (ISO dates) covered by the last (or index) anomality report
+    and the predicted average temperature for each of them as a NumPy array.
+    """
+    row = anomalities_df.iloc[index]
+    # month_range is inclusive; the report covers 7 months starting from its date
+    months = list(month_range(row.name, 7))[:7]
+    month_numbers = [ int(m[5:7]) for m in months ]
+    temps = row[[f'month{n}' for n in range(7)]].values.astype(float) \
+        + avg_df.avg_temp.loc[month_numbers].values
+    return (months, temps)
+
+def predict_heating(lin_coef, lin_intercept, lin_score,
+                    log_coef, log_intercept, log_score, temps):
+    """
+    Predict heating for a set of buildings (model parameter arrays of length B) for
+    temps (array of length M, or a B x M matrix), returns a B x M matrix. For each
+    building the model with the better score is used.
+    """
+    col = lambda a: np.asarray(a, dtype = float)[:, None]
+    temps = np.asarray(temps, dtype = float)
+    lin = col(lin_coef) * temps + col(lin_intercept)
+    # Log model is fitted against log(heat + LOG_OFFSET)
+    log = np.exp(col(log_coef) * temps + col(log_intercept)) - LOG_OFFSET
+    use_lin = col(lin_score) > col(log_score)
+    return np.where(use_lin, lin, log)
+
+class Prognoses:
+    """
+    Heating prognoses for all buildings, computed at once for the latest anomality report.
+    usage:
+    - prognoses = Prognoses(buildings_df, avg_df, anomalities_df)
+    - df = prognoses.for_building('091-001-0001-0001')
+    """
+    def __init__(self, buildings_df, avg_df, anomalities_df):
+        (self.months, temps) = predicted_temperatures(avg_df, anomalities_df)
+        self.report = anomalities_df.index[-1]
+        self.values = predict_heating(
+            buildings_df.lin_coef.values, buildings_df.lin_intercept.values, buildings_df.lin_score.values,
+            buildings_df.log_coef.values, buildings_df.log_intercept.values, buildings_df.log_score.values,
+            temps)
+        self._index = { building: i for (i, building) in enumerate(buildings_df.index) }
+
+    def __contains__(self, building):
+        return building in self._index
+
+    def for_building(self, building):
+        """
+        Returns the prognosis for building in the same format as make_prognosis
+        """
+        return pd.DataFrame(
+            self.values[self._index[building]],
+            index = self.months,
+            columns = ['heating']
+        )
 
 def make_prognosis(building, avg_df, anomalities_df):
     """
     Make prognosis on building energy consumtion, when served with the
     average temperature and the latest temperature anomalities.
+    Use Prognoses when predicting for more than one building.
     """
-    df = anomalities_for(anomalities_df)
-    df['month'] = df.index.str[5:7].astype(int)
-    df2 = df.merge(how='left', right = avg_df, left_on = 'month', right_index = True)
-    df2['predicted_temp'] = df2.anomality + df2.avg_temp
-    # Choose the best model
-    model = unthaw(building.lin_model) if building.lin_score > building.log_score else unthaw(building.log_model)
-    prediction = model.predict(df2.predicted_temp.values.reshape(-1, 1))
-    return pd.DataFrame(
-        prediction,
-        index = df.index,
-        columns = ['heating']
-    )
-
+    return Prognoses(pd.DataFrame([building]), avg_df, anomalities_df).for_building(building.name)
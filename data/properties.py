@@ -1,11 +1,13 @@
 import pandas as pd
-import numpy as np
 import urllib.parse as urlparse
+import json
 
 try:
     from lib import open_url, debug
+    from lib.fetch import parallel_map
 except ModuleNotFoundError:
     from ..lib import open_url, debug
+    from ..lib.fetch import parallel_map
 
 def get_property_list():
     """
@@ -15,85 +17,85 @@ def get_property_list():
                                  mode='rb'))
 
 PROPERTY_RESOURCE = 'https://helsinki-openapi.nuuka.cloud/api/v1.0/Property/Search'
-def fetchPropData(row):
+def fetch_property_records(code, update = None):
     """
-    Fetches one property data row.
+    Fetches the search result records (list of dicts) for a property code.
     Throws IOError (HTTPError) if data not found.
     """
     params = urlparse.urlencode(
         { 'SearchFromRecord': 'PropertyCode',
-          'SearchString': row['propertyCode'] })
-    search_url = f'{PROPERTY_RESOURCE}?{params}'
-    ret = pd.read_json(open_url(search_url))
-    return ret
+          'SearchString': code })
+    with open_url(f'{PROPERTY_RESOURCE}?{params}', update = update) as fh:
+        return json.load(fh)
 
-def fetchPropDataGenerator(props_df):
+def valid_codes(props_df):
     """
-    A generator that returns (yields) all valid properties row by row.
+    Property codes of the property list, stripped; properties missing a code are left out.
     """
-    for index, row in props_df.iterrows():
-        try:
-            # There are some properties missing property codes :/
-            code = row['propertyCode']
-            # Missing data
-            if not code:
-                code = ''
+    codes = props_df.propertyCode.fillna('').astype(str).str.strip()
+    # There are some properties missing property codes :/
+    for name in props_df.propertyName[codes == ''] if 'propertyName' in props_df else []:
+        debug('Missing property code:', name)
+    return props_df.assign(propertyCode = codes)[codes != '']
 
-            code = code.strip()
-            if code != '':
-                yield fetchPropData(row)
-            else:
-                debug('Missing property code:', row )
-        except IOError:
-            # Some properties return 404 :)
-            debug('Not found: ', code)
-            pass
-
-def extract_primary_building(s):
+def get_property_catalogue(previous = None):
     """
-    Extract the first building code; currently we are not using other than the
-    'primary' building, but later on this could change..
+    Fetch the search records of all properties in the property list into one table,
+    one row per record. The queried property code is kept in column searchCode.
+    previous: Earlier catalogue; only properties that are new or renamed in the
+              property list since are queried (again).
     """
-    d = {}
-    if len(s) >= 1:
-        b = s[0]
-        if 'buildingCode' in b and b['buildingCode']:
-            buildingCode = b['buildingCode'].strip()
-            if len(buildingCode) > 0:
-                d['buildingCode'] = buildingCode
-    return d
+    props_df = valid_codes(get_property_list())
+    codes = props_df.propertyCode
+    kept = None
+    if previous is not None and len(previous):
+        # Names the catalogue was built with, per queried code
+        previous = previous.assign(searchCode = previous.searchCode.astype(str))
+        known = previous.groupby('searchCode').listName.first()
+        unchanged = codes.map(known).eq(props_df.propertyName)
+        kept = previous[previous.searchCode.isin(codes[unchanged])]
+        codes = codes[~unchanged]
+    names = dict(zip(props_df.propertyCode, props_df.propertyName))
+    debug(f'Querying {len(codes)} of {len(props_df)} properties')
+    records = []
+    for (code, ret, err) in parallel_map(
+            lambda code: fetch_property_records(code, update = True if kept is not None else None), codes):
+        if isinstance(err, IOError):
+            # Some properties return 404 :)
+            debug('Not found: ', code)
+        elif err:
+            raise err
+        else:
+            records += [ { **r, 'searchCode': code, 'listName': names[code] } for r in ret ]
+    df = pd.DataFrame.from_records(records)
+    if 'buildings' in df:
+        # Currently we are not using other than the 'primary' building, but later on this could change..
+        codes = df.buildings.str[0].str.get('buildingCode').str.strip()
+        df['buildingCode'] = codes.where(codes != '')
+        df.drop(columns = 'buildings', inplace = True)
+    if kept is not None:
+        df = pd.concat([kept, df], ignore_index = True)
+    return df.reset_index(drop = True)
 
-def get_properties():
+def get_properties(catalogue = None):
     """
     Fetch all properties with data.
+    catalogue: Property catalogue to use, see get_property_catalogue (fetched if not given)
     """
-    properties = get_property_list()
-    properties_df =  pd.concat(list(fetchPropDataGenerator(properties)))
-
-    buildingCode = properties_df.buildings.apply(
-        lambda s: pd.Series(extract_primary_building(s), dtype=np.object))
+    if catalogue is None:
+        catalogue = get_property_catalogue()
     # Drop fields we currently don't use
-    properties_df.drop(['yearOfIntroduction',
-                        'purposeOfUse',
-                        'buildingType',
-                        'buildings'],
-                       axis = 1, inplace = True)
-    # Convert coordinates to numeric
-    def fixLatLng(col):
-        if col.name in ['latitude', 'longitude']:
-            # Missing or invalid values will be converted to NaN and cand be later dropped
-            return pd.to_numeric(col, errors = 'coerce')
-        return col
-    properties_df = properties_df.apply(fixLatLng)
-    df =  pd.concat([properties_df, buildingCode], axis = 1)
-    # Need to have a unique index for the drop to work properly
-    df.reset_index(drop = True, inplace = True)
+    df = catalogue.drop(['yearOfIntroduction',
+                         'purposeOfUse',
+                         'buildingType',
+                         'searchCode',
+                         'listName'],
+                        axis = 1, errors = 'ignore')
+    # Missing or invalid coordinates will be converted to NaN and can be dropped
+    df = df.assign(latitude = pd.to_numeric(df.latitude, errors = 'coerce'),
+                   longitude = pd.to_numeric(df.longitude, errors = 'coerce'))
     # Remove rows that lack buildingCode or coordinates
-    df.drop(
-        df[
-            df.buildingCode.isna() | df.latitude.isna() | df.longitude.isna()
-        ].index, inplace = True)
+    df = df[df.buildingCode.notna() & df.latitude.notna() & df.longitude.notna()]
     # also remove duplicated buildings
-    df.drop_duplicates(subset='buildingCode', inplace = True)
-    df.set_index('buildingCode', inplace = True)
-    return df
+    df = df.drop_duplicates(subset = 'buildingCode')
+    return df.set_index('buildingCode')
@@ -1,22 +1,25 @@
 #@title
 # Seasonal anomalities
+import os
 import re
+import csv
+import zipfile
 import numpy as np
 import pandas as pd
 import datetime
-import multiprocessing as mp
 import matplotlib.image as mpimg
+from PIL import Image
 
 try:
     from config import config
     from lib import debug, open_url
-    from lib.cache import open_cached, cached_name
-    from lib.util import month_range
+    from lib.cache import CACHE_PATH, create_cachedir, open_cached, has_cached, cached_name
+    from lib.jobs import run_jobs, default_workers
 except ModuleNotFoundError:
     from ..config import config
     from ..lib import debug, open_url
-    from ..lib.cache import open_cached, cached_name
-    from ..lib.util import month_range
+    from ..lib.cache import CACHE_PATH, create_cachedir, open_cached, has_cached
+    from ..lib.jobs import run_jobs, default_workers
 
 # All seasonal data is found under this URL
 SEASONAL_BASE_URL = 'https://ies-ows.jrc.ec.europa.eu/SeasonalForecast'
@@ -73,113 +76,272 @@ def generate_calibration_coords():
     return tcoord_minus + tcoord_plus
 
 TEMP_CALIBRATION_COORDS = generate_calibration_coords()
+# Expected (height, width) of the anomaly maps
+IMAGE_SHAPE = (4810, 6260)
+# Pixels sampled around each point of interest; borders between zones are about 10
+SAMPLE_RADIUS = 20
+
 def to_rgb(arr):
     """
-    Extract rgb part of a rgba float array (ex. numpy.ndarray) to a hashable tuple
+    Extract rgb part of a uint8 rgb(a) array (ex. numpy.ndarray) to a hashable tuple
+    """
+    return tuple(int(c) for c in arr[:3])
+
+class MapSample:
+    """
+    The parts of an anomaly map we are interested in, as uint8 RGB:
+    - calibration: pixels at TEMP_CALIBRATION_COORDS
+    - windows: point (col, row) -> (2 * radius + 1) x (2 * radius + 1) pixels centered on point
     """
-    (r,g,b,a) = arr * 255
-    return (int(r),int(g),int(b))
+    def __init__(self, calibration, windows, radius):
+        self.calibration = calibration
+        self.windows = windows
+        self.radius = radius
+
+    @staticmethod
+    def decode(f, points, radius = SAMPLE_RADIUS):
+        """
+        Sample the PNG image in file f. The image is decoded in its native 8-bit
+        format and only the sampled pixels are kept.
+        """
+        with Image.open(f) as img:
+            if (img.height, img.width) != IMAGE_SHAPE:
+                raise Exception('Image shape has changed, must re-calibrate')
+            img.load()
+            # Crop before converting, so that palette images are never expanded as a whole
+            def rgb_crop(box):
+                return np.asarray(img.crop(box).convert('RGB'))
+            calibration = np.array([ rgb_crop((col, row, col + 1, row + 1))[0, 0]
+                                     for (row, col, _) in TEMP_CALIBRATION_COORDS ])
+            windows = { (col, row): rgb_crop((col - radius, row - radius,
+                                              col + radius + 1, row + radius + 1))
+                        for (col, row) in points }
+        return MapSample(calibration, windows, radius)
+
+    def save(self, fh):
+        points = list(self.windows.keys())
+        np.savez(fh, calibration = self.calibration, points = np.array(points, dtype = int).reshape(-1, 2),
+                 windows = np.array([ self.windows[p] for p in points ], dtype = np.uint8),
+                 radius = self.radius)
+
+    @staticmethod
+    def load(fh):
+        d = np.load(fh)
+        windows = { tuple(int(c) for c in p): w for (p, w) in zip(d['points'], d['windows']) }
+        return MapSample(d['calibration'], windows, int(d['radius']))
 
-def get_temp_map(img):
+def sample_image(fn, points, radius = SAMPLE_RADIUS):
+    """
+    Returns the MapSample of points in image fn of the repository. Samples are cached,
+    so each image only needs to be downloaded and decoded once.
+    """
+    name = f'seasonal_sample:{fn}:{radius}:' + ';'.join(f'{c},{r}' for (c, r) in points)
+    if has_cached(name):
+        try:
+            with open_cached(name, 'rb') as fh:
+                return MapSample.load(fh)
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            # Broken sample (e.g. from an older version); sample again
+            debug(f'Unreadable sample of {fn}: {e!r}')
+    with open_url(f'{SEASONAL_BASE_URL}/{fn}', 'rb') as f:
+        sample = MapSample.decode(f, points, radius)
+    # Write atomically, a job killed while saving must not leave a truncated sample
+    path = cached_name(name)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmp = f'{path}.tmp{os.getpid()}'
+    try:
+        with open(tmp, 'wb') as fh:
+            sample.save(fh)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return sample
+
+def get_temp_map(sample):
     """
     Generates a dictionary with color -> temp mapping by reading predefined coordinates
-    from the image.
+    from the image sample.
+    """
+    return { to_rgb(rgb): t for (rgb, (_, _, t)) in zip(sample.calibration, TEMP_CALIBRATION_COORDS) }
+
+# Colors within this (RGB euclidean) distance from a palette color are classified as it;
+# antialiasing produces in-between colors at zone borders.
+COLOR_TOLERANCE = 12
+
+def pack_rgb(arr):
     """
-    return { to_rgb(img[row, col]): t for (row, col, t) in TEMP_CALIBRATION_COORDS }
+    Pack the RGB triplets of a uint8 array (..., 3) into 24-bit integer keys (...)
+    """
+    arr = np.asarray(arr, dtype = np.int32)
+    return (arr[..., 0] << 16) | (arr[..., 1] << 8) | arr[..., 2]
+
+class Palette:
+    """
+    Color -> temperature classifier for an anomaly map, calibrated from the map itself
+    (falling back to the manually extracted TEMP_MAP colors).
+    """
+    def __init__(self, sample):
+        mapping = { **TEMP_MAP, **get_temp_map(sample) }
+        self.colors = np.array(list(mapping.keys()), dtype = np.int32)
+        self.keys = pack_rgb(self.colors)
+        self.temps = np.array(list(mapping.values()), dtype = float)
+
+    def classify(self, pixels, tolerance = COLOR_TOLERANCE):
+        """
+        Classify uint8 RGB pixels (..., 3) to temperatures (...); NaN where the color
+        isn't within tolerance of any palette color.
+        """
+        pixels = np.asarray(pixels)
+        shape = pixels.shape[:-1]
+        flat = pixels.reshape(-1, 3).astype(np.int32)
+        # Exact hits are the common case
+        exact = pack_rgb(flat)[:, None] == self.keys[None, :]
+        dist2 = ((flat[:, None, :] - self.colors[None, :, :]) ** 2).sum(axis = 2)
+        dist2[exact] = -1
+        nearest = dist2.argmin(axis = 1)
+        temps = self.temps[nearest]
+        temps[dist2[np.arange(len(flat)), nearest] > tolerance ** 2] = np.nan
+        return temps.reshape(shape)
+
+    def classify_window(self, window):
+        """
+        Returns the temperature of the classified pixel nearest to the window center, or NaN
+        """
+        temps = self.classify(window)
+        (rows, cols) = np.indices(temps.shape)
+        (r, c) = ((temps.shape[0] - 1) / 2, (temps.shape[1] - 1) / 2)
+        dist = (rows - r) ** 2 + (cols - c) ** 2
+        dist = np.where(np.isnan(temps), np.inf, dist)
+        i = dist.argmin()
+        return temps.flat[i] if np.isfinite(dist.flat[i]) else np.nan
+
+def anomalies_at(sample, points):
+    """
+    Returns the temperature anomalies at points (col, row) of the image sample as an array
+    (NaN where not found). Each point must have been sampled.
+    """
+    palette = Palette(sample)
+    return np.array([ palette.classify_window(sample.windows[p]) for p in points ])
 
 def get_seasonal_temp_anomaly_from(fn):
     """
     Fetch the given filename from the repository and figure out the seasonal anomality temperature
     for Helsinki.
     """
-    with open_url(f'{SEASONAL_BASE_URL}/{fn}', 'rb') as f:
-        img = mpimg.imread(f)
-        if img.shape != (4810, 6260, 4):
-            raise Exception('Image shape has changed, must re-calibrate')
-
-        tempmap = get_temp_map(img)
-        rgb = to_rgb(img[HELSINKI_COORD[1], HELSINKI_COORD[0] ])
-        if rgb in tempmap:
-            return tempmap[rgb]
-        if not rgb in tempmap:
-            # Maps can have a gray border around differing temperature zones, fuzz around it before giving up
-            for fuzz_x in range(1,21): # Borders are about size 10; so this should be enough (+-20)
-                for fuzz_y in range(0,21):
-                    # Search in all directions
-                    for mult in [(1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                        rgb = to_rgb(img[HELSINKI_COORD[1] + (mult[0] * fuzz_x),
-                                         HELSINKI_COORD[0] + (mult[1] * fuzz_y) ])
-                        if rgb in tempmap:
-                            return tempmap[rgb]
-                        elif rgb in TEMP_MAP:
-                            return TEMP_MAP[rgb]
-
-        debug('Temperature not found in tempmap?')
-        debug('Color map:',TEMP_MAP)
-        if config.DEBUG:
-            dbgname = 'debug_anomality_image.png'
-            debug(f'Saving a copy of the problematic image as "{dbgname}"')
-            mpimg.imsave(dbgname, img)
-
-        raise Exception(f'Color {rgb} not found in mapping?')
-    raise Exception('Fail')
+    sample = sample_image(fn, [HELSINKI_COORD])
+    t = anomalies_at(sample, [HELSINKI_COORD])[0]
+    if not np.isnan(t):
+        return t
+
+    debug('Temperature not found in tempmap?')
+    debug('Color map:',TEMP_MAP)
+    if config.DEBUG:
+        dbgname = 'debug_anomality_image.png'
+        debug(f'Saving a copy of the problematic image region as "{dbgname}"')
+        mpimg.imsave(dbgname, sample.windows[HELSINKI_COORD])
+
+    raise Exception(f'No known color around {HELSINKI_COORD} in {fn}')
 
 RE_IMAGE = re.compile(r'^SeasonalAnomalies_T2m_(?P<date>\d+)_m(?P<n>\d)\.png')
-CACHE_SEASONAL='cache_seasonal_anomalities'
-def process_image(t):
-    (d, n, fn) = t
-    return (d, n, get_seasonal_temp_anomaly_from(fn))
+# Append-only store of processed images: one row per image and location
+SEASONAL_STORE = f'{CACHE_PATH}/seasonal_anomalities.csv'
+SEASONAL_STORE_COLUMNS = ['image', 'date', 'month', 'location', 'anomaly']
 
-def get_seasonal_anomalities():
-    # Since it takes quite a while to generate this; it's only smart to cache it once done
-    try:
-        df = pd.read_json(open_cached(CACHE_SEASONAL))
-        if config.DEBUG:
-            debug('Returning cached seasonal data from', cached_name(CACHE_SEASONAL))
-        return df
-    except FileNotFoundError:
-        # Ok, need to do the gathering
-        pass
+def process_image(t):
+    (d, n, fn, points) = t
+    return (d, n, fn, points, anomalies_at(sample_image(fn, points), points))
 
+def read_image_index():
+    """
+    Returns the images listed in the repository as a list of (date, month index, filename)
+    """
     # Text file containing file names for the temperature prognosis images
     # the format is 'SeasonalAnomalies_T2m_<YYYYMMDD>_m<N>.png' where Y, M, D are for the date and M is the month number
     # 1 = for the prognosis date month, e.g. for 20200901 N=1 and N7 is for march next year
     f = open_url(f'{SEASONAL_BASE_URL}/T2m_index.txt')
-    lines = f.read().split('\n')
-    lines.remove('') # Last entry
-    anomalities = dict() # date -> list
-    def image_data(fn):
+    images = []
+    for fn in f.read().split('\n'):
         m = RE_IMAGE.match(fn)
         if m:
             day = datetime.datetime.strptime(m.group('date'), '%Y%m%d')
             n = int(m.group('n')) - 1 # indexing starts from 1 in file :/
-            if not day in anomalities:
-                anomalities[day] = [ np.NaN for _ in range(7) ]
-            return (day, n, fn)
-
-    # Run in parallel
-    pool = mp.Pool()
-    temps = pool.map(process_image,
-                     [ image_data(fn) for fn in lines ])
-    # Remap
-    for (d,n,t) in temps:
-        anomalities[d][n] = t
-    df = pd.DataFrame([(k,) + tuple(v) for (k,v) in anomalities.items()],
-                      columns = ['date'] + [f'month{n}' for n in range(7)])
-    df.set_index('date', inplace = True)
-    df.to_json(open_cached(CACHE_SEASONAL, mode='w'))
-    return df
+            images.append((day, n, fn))
+    return images
+
+def read_store():
+    try:
+        return pd.read_csv(SEASONAL_STORE, parse_dates = ['date'])
+    except FileNotFoundError:
+        return pd.DataFrame(columns = SEASONAL_STORE_COLUMNS)
+
+def append_store(results):
+    """
+    Append process_image results to the store
+    """
+    new = not os.path.exists(SEASONAL_STORE)
+    create_cachedir()
+    with open(SEASONAL_STORE, 'a', newline = '') as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(SEASONAL_STORE_COLUMNS)
+        for (d, n, fn, points, temps) in results:
+            for (p, t) in zip(points, temps):
+                writer.writerow([fn, d.strftime('%Y-%m-%d'), n, location_key(p), t])
 
-def anomalities_for(anomalities, index = -1):
+def collect_anomalities(points):
     """
-    Returns a DataFrame with the dates for the last (or index) anomality report.
+    Read the anomalities at points (col, row) from all images in the repository.
+    Only images (and points) not already in the store are downloaded and processed.
+    Returns a dictionary date -> 7 x len(points) array (month, point).
     """
-    row = anomalities.iloc[index]
-    start_month = row.name
-    df = pd.DataFrame(row)
-    # Value row gets the index name - rename it
-    df.rename(columns=lambda x: 'month' if len(x) == 0 else 'anomality', inplace = True)
-    # Now need to rename indexes from "month0".. to start_month..
-    new_index = list(month_range(row.name, 7))
-    df.rename(index = lambda x: new_index[int(x[-1])], inplace = True)
+    images = read_image_index()
+    store = read_store()
+    done = set(zip(store.image, store.location))
+    jobs = []
+    for (d, n, fn) in images:
+        missing = [ p for p in points if not (fn, location_key(p)) in done ]
+        if missing:
+            jobs.append((d, n, fn, missing))
+    debug(f'Processing {len(jobs)} of {len(images)} seasonal anomaly images')
+
+    if jobs:
+        # Run in parallel, storing results as they come; failed images are retried on the next run
+        failures = run_jobs(process_image, jobs,
+                            lambda job, result: append_store([result]),
+                            workers = default_workers(config.SEASONAL_IMAGE_MEMORY),
+                            timeout = config.SEASONAL_IMAGE_TIMEOUT,
+                            label = 'Seasonal images')
+        for ((_, _, fn, _), error) in failures:
+            debug(f'Failed to process {fn}: {error}')
+        store = read_store()
+
+    keys = [ location_key(p) for p in points ]
+    column = { key: i for (i, key) in enumerate(keys) }
+    listed = set(fn for (_, _, fn) in images)
+    anomalities = dict() # date -> array
+    for (fn, d, n, location, t) in store[SEASONAL_STORE_COLUMNS].itertuples(index = False):
+        if fn in listed and location in column:
+            if not d in anomalities:
+                anomalities[d] = np.full((7, len(points)), np.nan)
+            anomalities[d][n, column[location]] = t
+    return dict(sorted(anomalities.items()))
+
+def get_seasonal_anomalities():
+    """
+    Seasonal anomalities for Helsinki; date -> month0..month6.
+    """
+    anomalities = collect_anomalities([HELSINKI_COORD])
+    for (d, v) in anomalities.items():
+        if np.isnan(v[:, 0]).any():
+            debug(f'No known color around {HELSINKI_COORD} in report {d}')
+    if anomalities and np.isnan(list(anomalities.values())[-1][:, 0]).any():
+        raise Exception('Latest report lacks anomalities for Helsinki')
+    df = pd.DataFrame([(k,) + tuple(v[:, 0]) for (k,v) in anomalities.items()],
+                      columns = ['date'] + [f'month{n}' for n in range(7)])
+    df.set_index('date', inplace = True)
     return df
+
+def location_key(point):
+    return f'{point[0]}:{point[1]}'
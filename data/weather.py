@@ -5,67 +5,97 @@ import datetime
 
 try:
     from lib import open_url, debug
+    from lib.fetch import parallel_map
+    import data.climatology as climatology
 except ModuleNotFoundError:
     from ..lib import open_url, debug
+    from ..lib.fetch import parallel_map
+    from ..data import climatology
 
-def get_decade_temperatures():
+# Helsinki area weather stations
+FMI_STATIONS = [101007, 101004, 100971, 100973]
+FIRST_YEAR = 2010
+FMI_DAILY_URL = 'https://opendata.fmi.fi/wfs?request=getFeature&storedquery_id=fmi%3A%3Aobservations%3A%3Aweather%3A%3Adaily%3A%3Atimevaluepair&crs=EPSG%3A%3A3067&fmisid={fmi_id}&starttime={year}-01-01T00:00:00Z&endtime={year}-12-31T23:59:59Z'
+WML2 = '{http://www.opengis.net/waterml/2.0}'
+# The daily query returns several time series; the second one is the daily mean temperature
+TEMPERATURE_SERIES = 1
+
+def parse_daily_temperatures(fh):
     """
-    Gather weather data for 2010-now
+    Parse an FMI daily observation document incrementally.
+    Returns (dates, temperatures) as NumPy arrays (datetime64[D], float).
     """
-    ids = [101007, 101004, 100971, 100973]
-    df = pd.DataFrame()
-    for fmi_id in ids:
-        days = []
-        avg_temperatures = []
-        today = datetime.date.today()
-        for year in range(2010, today.year + 1):
-            with open_url(f'https://opendata.fmi.fi/wfs?request=getFeature&storedquery_id=fmi%3A%3Aobservations%3A%3Aweather%3A%3Adaily%3A%3Atimevaluepair&crs=EPSG%3A%3A3067&fmisid={fmi_id}&starttime={year}-01-01T00:00:00Z&endtime={year}-12-31T23:59:59Z', mode='rb') as fh:
-                etree = ET.parse(fh)
-                root = etree.getroot()
-                try:
-                    for child in root[1][0][6][0]:
-                        days.append(child[0][0].text)
-                        avg_temperatures.append(child[0][1].text)
-                except:
-                    pass
-
-        temps = pd.DataFrame(list(zip(days, avg_temperatures)), columns=["date", "avg_temp"])
-        temps[fmi_id] = temps["avg_temp"].astype("float")
-        temps.drop("avg_temp", axis=1, inplace=True)
-        temps["date"] = pd.to_datetime(temps["date"])
-        temps["date"] = temps["date"].dt.date
-        temps = temps.groupby([temps['date']])[fmi_id].mean()
+    dates = np.empty(366, dtype = 'datetime64[D]')
+    temps = np.empty(366, dtype = float)
+    n = 0
+    series = -1
+    for (event, elem) in ET.iterparse(fh, events = ('start', 'end')):
+        if event == 'start':
+            if elem.tag == f'{WML2}MeasurementTimeseries':
+                series += 1
+            continue
+        if elem.tag == f'{WML2}MeasurementTVP':
+            if series == TEMPERATURE_SERIES:
+                if n == len(dates):
+                    dates = np.resize(dates, 2 * n)
+                    temps = np.resize(temps, 2 * n)
+                dates[n] = elem.findtext(f'{WML2}time')[:10]
+                temps[n] = float(elem.findtext(f'{WML2}value'))
+                n += 1
+            elem.clear()
+        elif elem.tag == f'{WML2}MeasurementTimeseries' and series == TEMPERATURE_SERIES:
+            break
+    return (dates[:n], temps[:n])
 
-        if df.shape[0] == 0:
-            df = temps
-        else:
-            df = pd.merge(df,
-                          temps,
-                          how="outer",
-                          left_index=True,
-                          right_index=True)
+def fetch_station_year(t):
+    (fmi_id, year) = t
+    # Past years don't change, only revalidate the current one
+    with open_url(FMI_DAILY_URL.format(fmi_id = fmi_id, year = year), mode='rb',
+                  update = year == datetime.date.today().year) as fh:
+        return parse_daily_temperatures(fh)
 
+def get_daily_temperatures():
+    """
+    Daily mean temperatures since FIRST_YEAR, one column per station
+    """
+    today = datetime.date.today()
+    jobs = [ (fmi_id, year) for fmi_id in FMI_STATIONS for year in range(FIRST_YEAR, today.year + 1) ]
+    station_data = { fmi_id: [] for fmi_id in FMI_STATIONS }
+    for ((fmi_id, year), data, err) in parallel_map(fetch_station_year, jobs):
+        if isinstance(err, ET.ParseError):
+            # Same as before: a broken document is skipped
+            debug(f'No temperatures for station {fmi_id} in {year}: {err}')
+            continue
+        elif err:
+            raise err
+        station_data[fmi_id].append(data)
+    stations = []
+    for (fmi_id, data) in station_data.items():
+        dates = np.concatenate([ d for (d, _) in data ]) if data else np.array([], dtype = 'datetime64[D]')
+        temps = np.concatenate([ t for (_, t) in data ]) if data else np.array([], dtype = float)
+        stations.append(pd.Series(temps, index = pd.DatetimeIndex(dates), name = fmi_id)
+                        .groupby(level = 0).mean())
+    df = pd.concat(stations, axis = 1)
+    df.index.name = 'date'
+    return df
 
-    df["avg_temp"] = df.mean(axis=1)
-    df.drop([101007, 101004, 100971, 100973], axis=1, inplace=True)
-    df.index = pd.to_datetime(df.index)
-    df = df.groupby(pd.Grouper(freq='M')).mean()
-
-    #Set data for each month to be listed on first day of the month
-    df.index = pd.to_datetime(df.reset_index()["date"].apply(lambda x: x.strftime('%Y-%m')))
+def get_decade_temperatures(daily_df = None):
+    """
+    Gather weather data for 2010-now
+    daily_df: Daily temperatures as provided by get_daily_temperatures() (fetched if not given)
+    """
+    if daily_df is None:
+        daily_df = get_daily_temperatures()
+    # Data for each month is listed on the first day of the month
+    df = climatology.monthly_means(daily_df.mean(axis=1).to_frame("avg_temp"))
+    df.index.name = "date"
     return df
 
-def get_monthly_averages(temp_df):
+def get_monthly_averages(temp_df, years = None):
     """
     Return average temperatures per month for temp_df,
     which is expected to be in the format provided by get_decade_temperatures()
+    years: Only average over the last years
     """
-    avgs = list((0,0) for _ in range(0,12)) # (count, sum) for each month
-    for index, row in temp_df.iterrows():
-        month = int(index[5:7]) - 1
-        counts = avgs[month]
-        temp = row.avg_temp + 273 # Kelvin-ish
-        avgs[month] = (counts[0] + 1, counts[1] + temp)
-    # Calculate averages
-    avgs = list(map(lambda i: (i[1] / i[0]) - 273, avgs))
-    return pd.DataFrame(avgs, index = range(1,13), columns=['avg_temp'])
+    climate = climatology.climatology(temp_df[['avg_temp']], years, percentiles = [])
+    return pd.DataFrame({ 'avg_temp': climate.set_index('month')['mean'] }).reindex(range(1, 13)).rename_axis(None)
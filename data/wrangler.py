@@ -1,16 +1,31 @@
 import pandas as pd
+import hashlib
+import json
+import time
 import os
 
 try:
-    from lib import debug
+    import graphics
+    from lib import debug, columnar
+    from lib.jobs import run_jobs
     import data.weather as weather, data.energy as energy, data.properties as properties
     import data.seasonal_anomalities as seasonal_anomalities
+    import data.climatology as climatology
 except ModuleNotFoundError:
-    from ..lib import debug
-    from ..data import weather, energy, properties, seasonal_anomalities
+    from .. import graphics
+    from ..lib import debug, columnar
+    from ..lib.jobs import run_jobs
+    from ..data import weather, energy, properties, seasonal_anomalities, climatology
 
 # Directory for store
 DATA_STORE = 'datastore'
+# Pre-rendered energy history charts
+CHART_DIR = f'{DATA_STORE}/charts'
+CHART_MANIFEST = f'{CHART_DIR}/manifest.json'
+# Binary column stores, migrated from the CSV files on first read
+COLUMNAR_DIR = f'{DATA_STORE}/columnar'
+# Written by fetch_data when done, running servers reload the store when it changes
+GENERATION_FILE = f'{DATA_STORE}/generation'
 
 class get_data:
     """
@@ -18,50 +33,275 @@ class get_data:
     usage:
     - df = get_data('key').or_fail()              # Fails if there is no data in store
     - df = get_data('key').or_else(generate_data) # Generates data if there is no data
+    - df = get_data('key').or_else(generate_data, refresh = True) # Always regenerates
+    - df = get_data('key').or_none()              # None if there is no data in store
+    - get_data('key').store(df)                   # Replaces the data in store
+    Data is stored as CSV, with a binary column store (see lib.columnar) next to it
+    that is used for reading whenever it is up to date with the CSV file.
+    read_only: Don't write missing or outdated column stores when reading
     """
-    def __init__(self, name):
+    def __init__(self, name, read_only = False):
         self.fn = f'{DATA_STORE}/{name}.csv'
+        self.columnar = f'{COLUMNAR_DIR}/{name}'
+        self.read_only = read_only
 
     def or_fail(self):
-        return pd.read_csv(self.fn, index_col = 0)
+        if columnar.is_current(self.columnar, self.fn):
+            return columnar.read(self.columnar)
+        df = pd.read_csv(self.fn, index_col = 0)
+        if not self.read_only:
+            self.store_columnar(df)
+        return df
 
-    def or_else(self, cb):
+    def or_none(self):
         try:
             return self.or_fail()
         except IOError:
-            # File not found, ignore
-            pass
+            return None
+
+    def store_columnar(self, df):
+        try:
+            os.makedirs(COLUMNAR_DIR, exist_ok = True)
+            columnar.write(df, self.columnar, os.stat(self.fn))
+            debug(f'Stored {self.fn} as column store {self.columnar}/')
+        except OSError as e:
+            # Read-only store etc. - can always fall back to CSV
+            debug(f'Could not write column store for {self.fn}: {e}')
+
+    def or_else(self, cb, refresh = False):
+        if not refresh:
+            try:
+                return self.or_fail()
+            except IOError:
+                # File not found, ignore
+                pass
         # Infer to callback
         df = cb()
-        df.to_csv(self.fn)
+        self.store(df)
         return df
+
+    def store(self, df):
+        df.to_csv(self.fn)
+        # The column store holds the frame as read from the CSV (dates as strings,
+        # categories as objects..), so that readers get the same either way
+        self.store_columnar(pd.read_csv(self.fn, index_col = 0))
 # / get_data
 
-def fetch_data():
+def datastore_fingerprint():
+    """
+    Short digest of the data store contents, based on file names, sizes and
+    modification times. Changes whenever fetch_data (re)writes any of the data sets.
+    """
+    h = hashlib.sha1()
+    try:
+        entries = sorted(os.scandir(DATA_STORE), key = lambda e: e.name)
+    except FileNotFoundError:
+        entries = []
+    for e in entries:
+        if e.is_file() and e.name.endswith('.csv'):
+            st = e.stat()
+            h.update(f'{e.name}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    return h.hexdigest()[:16]
+
+def write_generation():
+    """
+    Mark the data store contents complete as a new generation
+    """
+    generation = f'{time.time_ns()}-{datastore_fingerprint()}'
+    tmp = f'{GENERATION_FILE}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(generation)
+    os.replace(tmp, GENERATION_FILE)
+    return generation
+
+def read_generation():
+    """
+    The current generation of the data store, None for stores without a generation
+    file (see DatastoreManager, which writes one)
+    """
+    try:
+        with open(GENERATION_FILE) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def load_chart_manifest():
+    """
+    Returns the manifest of pre-rendered charts:
+    { 'fingerprint': <data store fingerprint>, 'charts': { building: digest } }
+    """
+    try:
+        with open(CHART_MANIFEST) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return { 'fingerprint': None, 'charts': {} }
+
+def chart_path(building):
+    return f'{CHART_DIR}/{building}.png'
+
+def digest(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(p if isinstance(p, bytes) else p.encode())
+    return h.hexdigest()
+
+# Temperatures for render workers, set once per worker by _init_render_worker
+_render_temps = None
+
+def _init_render_worker(temp_df):
+    global _render_temps
+    _render_temps = temp_df
+
+def _render_chart(job):
+    (building, heat, prognosis) = job
+    start = time.perf_counter()
+    png = graphics.render_energy_temperature_history(heat, _render_temps, prognosis)
+    # Write atomically, the server may be reading charts meanwhile
+    tmp = f'{chart_path(building)}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(png)
+    os.replace(tmp, chart_path(building))
+    return (building, time.perf_counter() - start)
+
+def render_charts(buildings_df, series_df, temp_df, avgtemp_df, anomalities_df, workers = None):
+    """
+    Render energy history charts for all buildings into CHART_DIR. Only buildings
+    whose data or the prognosis inputs changed since the last run are re-rendered.
+    """
+    if not os.path.exists(CHART_DIR):
+        debug(f'Creating chart directory at {CHART_DIR}/')
+        os.mkdir(CHART_DIR)
+    manifest = load_chart_manifest()
+    old_charts = manifest['charts']
+    inputs = digest(temp_df.to_json(), avgtemp_df.to_json(), anomalities_df.to_json())
+    heat_series = energy.HeatSeries(series_df)
+    charts = {
+        building: digest(inputs, row.to_json(), *[ a.tobytes() for a in heat_series.for_building(building) ])
+        for (building, row) in buildings_df.iterrows()
+    }
+    prognoses = energy.Prognoses(buildings_df, avgtemp_df, anomalities_df)
+    jobs = [ (building, heat_series.for_building(building), prognoses.for_building(building))
+             for (building, d) in charts.items()
+             if old_charts.get(building) != d or not os.path.isfile(chart_path(building)) ]
+    # Remove charts of buildings that no longer exist
+    for building in set(old_charts) - set(charts):
+        try:
+            os.unlink(chart_path(building))
+        except FileNotFoundError:
+            pass
+
+    debug(f'Rendering {len(jobs)} of {len(charts)} charts')
+    start = time.perf_counter()
+    def rendered(job, result):
+        (building, seconds) = result
+        debug(f'Rendered {building} in {seconds * 1000:.0f} ms')
+    failures = run_jobs(_render_chart, jobs, rendered, workers = workers, label = 'Charts',
+                        initializer = _init_render_worker, initargs = (temp_df,))
+    debug(f'Rendered {len(jobs) - len(failures)} charts in {time.perf_counter() - start:.1f} s')
+    # Failed charts are rendered on request by the server (and retried on the next run)
+    for ((building, _, _), _) in failures:
+        del charts[building]
+
+    with open(CHART_MANIFEST, 'w') as f:
+        json.dump({ 'fingerprint': datastore_fingerprint(), 'charts': charts }, f)
+
+def migrate_heat_series():
+    """
+    Older stores kept the heat data in one column per month of heating_models and
+    heated_buildings; move it to the heat_series table.
+    """
+    if os.path.exists(get_data('heat_series').fn):
+        return
+    models_df = get_data('heating_models').or_none()
+    if models_df is None:
+        return
+    debug('Moving heat data from heating_models to heat_series')
+    (models_df, series_df) = energy.heat_series_from_columns(models_df)
+    get_data('heat_series').store(series_df)
+    get_data('heating_models').store(models_df)
+    buildings_df = get_data('heated_buildings').or_none()
+    if buildings_df is not None:
+        get_data('heated_buildings').store(energy.heat_series_from_columns(buildings_df)[0])
+
+def property_catalogue(update = False):
+    """
+    The stored property catalogue, fetched if there is none.
+    update: Query new and renamed properties, see properties.get_property_catalogue
+    """
+    previous = get_data('property_catalogue').or_none()
+    if previous is not None and not update:
+        return previous
+    return get_data('property_catalogue').or_else(
+        lambda: properties.get_property_catalogue(previous), refresh = True)
+
+def fetch_data(render = False, workers = None, update_energy = False, update_properties = False,
+               update_anomalities = False, update_weather = False):
     """
     Fetch data from original sources and wrangle to appropriate dataframes.
+    render: Also pre-render the energy history charts for all buildings.
+    update_properties: Refresh the property catalogue from the property list. If the
+                       properties changed, the energy data is updated as well.
+    update_energy: Fetch the new months of energy data and refit the heating models.
+    update_weather: Fetch the temperatures of the current year again and recompute the
+                    monthly temperatures and climatologies.
+    update_anomalities: Process new seasonal anomaly reports.
+    workers: Number of processes used for rendering (default: cpu count).
     """
     if not os.path.exists(DATA_STORE):
         debug(f'Creating data store directory at {DATA_STORE}/')
         os.mkdir(DATA_STORE)
 
+    previous_properties = get_data('properties').or_none() if update_properties else None
     properties_df = get_data('properties').or_else(
-        lambda: properties.get_properties())
+        lambda: properties.get_properties(property_catalogue(update_properties)),
+        refresh = update_properties)
+    if update_properties and not update_energy and (
+            previous_properties is None or previous_properties.to_csv() != properties_df.to_csv()):
+        # New buildings need their energy history, renamed ones an updated heated_buildings
+        debug('Properties changed, updating energy data')
+        update_energy = True
+    # Past years come from the HTTP cache, only the current one is revalidated
+    daily_temp_df = get_data('daily_temperatures').or_else(
+        lambda: weather.get_daily_temperatures(), refresh = update_weather)
     temp_df = get_data('decade_temperatures').or_else(
-        lambda: weather.get_decade_temperatures())
+        lambda: weather.get_decade_temperatures(daily_temp_df), refresh = update_weather)
     avgtemp_df = get_data('avg_temperatures').or_else(
-        lambda: weather.get_monthly_averages(temp_df))
+        lambda: weather.get_monthly_averages(temp_df), refresh = update_weather)
+    climate_df = get_data('climatology').or_else(
+        lambda: climatology.rolling_climatologies(daily_temp_df), refresh = update_weather)
+    migrate_heat_series()
+    previous_energy = get_data('energy_series').or_none() if update_energy else None
+    energy_series = get_data('energy_series').or_else(
+        lambda: energy.get_energy_series(properties_df.index, previous = previous_energy),
+        refresh = update_energy)
+    # Everything below is derived from the energy series
+    heat_series = get_data('heat_series').or_else(
+        lambda: energy.get_heat_series(energy_series), refresh = update_energy)
     heating_models = get_data('heating_models').or_else(
-        lambda: energy.generate_heating_models(properties_df, temp_df))
+        lambda: energy.generate_heating_models(properties_df, temp_df, heat_series),
+        refresh = update_energy)
     heated_buildings = get_data('heated_buildings').or_else(
         lambda: pd.concat([properties_df, heating_models], axis = 1).drop(
-            heating_models[heating_models.datapoints.isna()].index)
-    )
+            heating_models[heating_models.datapoints.isna()].index),
+        refresh = update_energy)
+    # Only new images are processed, the rest comes from the image store
     anomalities = get_data('seasonal_anomalities').or_else(
-        lambda: seasonal_anomalities.get_seasonal_anomalities())
+        lambda: seasonal_anomalities.get_seasonal_anomalities(), refresh = update_anomalities)
+    if render:
+        # Read through the store, so that the charts see the same data as the server
+        render_charts(get_data('heated_buildings').or_fail(),
+                      get_data('heat_series').or_fail(),
+                      get_data('decade_temperatures').or_fail(),
+                      get_data('avg_temperatures').or_fail(),
+                      get_data('seasonal_anomalities').or_fail(),
+                      workers)
+    write_generation()
     return {
         'buildings': heated_buildings,
+        'energy_series': energy_series,
+        'heat_series': heat_series,
         'temperatures': temp_df,
         'avg_temperatures': avgtemp_df,
+        'climatology': climate_df,
         'seasonal_anomalities': anomalities,
     }
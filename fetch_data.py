@@ -2,10 +2,32 @@
 # IDS Project 2020
 # Gather data from original data-sources and store it processed locally
 
+import argparse
 import data.wrangler as wrangler
+from lib import httppool
 
 def main():
-    wrangler.fetch_data()
+    parser = argparse.ArgumentParser(description = 'Fetch and process data into the data store')
+    parser.add_argument('--render-charts', action = 'store_true',
+                        help = 'pre-render energy history charts for the server')
+    parser.add_argument('--workers', type = int, default = None,
+                        help = 'number of render processes (default: cpu count)')
+    parser.add_argument('--update-energy', action = 'store_true',
+                        help = 'fetch new months of energy data and refit the heating models')
+    parser.add_argument('--update-properties', action = 'store_true',
+                        help = 'query new and renamed properties from the property list '
+                               '(and update the energy data if any changed)')
+    parser.add_argument('--update-weather', action = 'store_true',
+                        help = 'fetch new temperatures and recompute the monthly averages')
+    parser.add_argument('--update-anomalities', action = 'store_true',
+                        help = 'process new seasonal anomaly reports')
+    args = parser.parse_args()
+    wrangler.fetch_data(render = args.render_charts, workers = args.workers,
+                        update_energy = args.update_energy,
+                        update_properties = args.update_properties,
+                        update_anomalities = args.update_anomalities,
+                        update_weather = args.update_weather)
+    httppool.pool.log_stats()
 
 if __name__ == '__main__':
     main()
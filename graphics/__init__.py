@@ -4,23 +4,33 @@ import matplotlib.dates as mdates
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 import datetime
+import io
 
-from lib.util import month_range
+from lib.util import month_range, period_dates
 
-def plot_energy_temperature_history(building, temp_df, prognosis_df, out):
+def plot_energy_temperature_history(heat, temp_df, prognosis_df, out):
     """
     Plots the energy vs. temperature inverse graph.
+    heat: (months, values) of the building, as returned by HeatSeries.for_building
     """
-    heat_data = building[list(month_range(building.heating_start, building.heating_stop))]
+    (months, values) = heat
+    dates = period_dates(months)
+    if len(dates):
+        # Missing months within the data are left as holes
+        heat_data = pd.Series(values, index = dates, name = 'value').reindex(
+            list(month_range(dates[0], dates[-1])))
+        last = dates[-1]
+    else:
+        # No history, only the prognosis
+        heat_data = pd.Series([], dtype = float, name = 'value')
+        last = prognosis_df.index[0]
     df = pd.merge(heat_data, temp_df["avg_temp"], left_index=True, right_index=True)
     # Now to fill the dots in between if data has holes in the end
-    for d in month_range(building.heating_stop, prognosis_df.index[-1]):
+    for d in month_range(last, prognosis_df.index[-1]):
         if not d in df.index:
             df.loc[d] = np.nan
     # Add prognosis
     df = df.merge(right = prognosis_df, left_index = True, right_index = True, how = 'left')
-    # The query results in some random column name for heat values, fix it:
-    df.rename(columns={heat_data.name: 'value'}, inplace = True)
 
     # Change to datetime
     df.rename(index = lambda s: datetime.datetime.fromisoformat(s), inplace = True)
@@ -48,3 +58,11 @@ def plot_energy_temperature_history(building, temp_df, prognosis_df, out):
     fig.tight_layout()
     fig.autofmt_xdate()
     fig.savefig(out)
+
+def render_energy_temperature_history(heat, temp_df, prognosis_df):
+    """
+    Renders the energy history chart of a building and returns it as PNG bytes.
+    """
+    buf = io.BytesIO()
+    plot_energy_temperature_history(heat, temp_df, prognosis_df, buf)
+    return buf.getvalue()
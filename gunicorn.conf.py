@@ -0,0 +1,21 @@
+# Production server configuration, see start_server --production
+import multiprocessing
+import os
+
+from config import config
+
+bind = f'0.0.0.0:{os.environ.get("PORT", "8000")}'
+# Load the data store once in the master; forked workers share it copy-on-write
+# (and the memory mapped column stores through the page cache)
+preload_app = True
+# Request threads wait on renders in the render pool, JSON requests don't wait for them
+workers = multiprocessing.cpu_count()
+worker_class = 'gthread'
+threads = config.SERVER_THREADS
+timeout = config.RENDER_TIMEOUT + 30
+# Watch threads don't survive the fork, start them in the workers
+config['DATASTORE_WATCH'] = False
+
+def post_fork(arbiter, worker):
+    import server
+    server.datastore.start()
@@ -1,22 +1,45 @@
 import os
-import urllib.request as urlreq
+import re
+import gzip
+import json
+import shutil
+import http.client
+import urllib.error
+import time
+import sqlite3
 import hashlib
+import argparse
+import threading
 from .debug import debug
+from . import fetch, httppool
+try:
+    from config import config
+except ModuleNotFoundError:
+    from ..config import config
 
+# Cache layout:
+# - <CACHE_PATH>/<ab>/<abcdef...>[.gz]: Cached objects, sharded by the first byte of the sha1
+# - <CACHE_PATH>/index.sqlite: URL, size, validators and access times of the cached URLs.
+#   Only indexed objects are subject to eviction.
 CACHE_PATH = 'cache'
-BUF_SIZE = 4096
+INDEX_NAME = 'index.sqlite'
+# Content types worth compressing on disk (if config.CACHE_COMPRESS)
+COMPRESSIBLE = re.compile(r'^(text/|application/(json|xml|.*\+xml))')
 
 def create_cachedir():
     if not os.path.exists(CACHE_PATH):
         debug(f"Creating cache directory for requests at {CACHE_PATH}/")
-        os.mkdir(CACHE_PATH)
+        os.makedirs(CACHE_PATH, exist_ok = True)
+
+def cache_key(name):
+    return hashlib.sha1(name.encode()).hexdigest()
 
 def cached_name(name):
     """
     Return the cache path for name
     """
-    hashname = hashlib.sha1(name.encode()).hexdigest()
-    return f'{CACHE_PATH}/{hashname}'
+    hashname = cache_key(name)
+    return f'{CACHE_PATH}/{hashname[:2]}/{hashname}'
 
 def has_cached(name):
     return os.path.isfile(cached_name(name))
@@ -26,35 +49,293 @@ def open_cached(name, mode='r'):
     Open file from cache. Check if file exists with has_cached first (if not overwriting /
     handling exception)
     """
-    create_cachedir()
-    return open(cached_name(name), mode=mode)
+    fn = cached_name(name)
+    os.makedirs(os.path.dirname(fn), exist_ok = True)
+    return open(fn, mode=mode)
+
+_local = threading.local()
+
+def index():
+    """
+    Returns the (per thread) connection to the cache index
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        # Connections can't be shared with forked children
+        create_cachedir()
+        db = sqlite3.connect(f'{CACHE_PATH}/{INDEX_NAME}', timeout = 60, isolation_level = None)
+        db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                        key TEXT PRIMARY KEY,
+                        url TEXT,
+                        size INTEGER,
+                        compressed INTEGER,
+                        etag TEXT,
+                        last_modified TEXT,
+                        fetched REAL,
+                        accessed REAL)''')
+        _local.db = db
+        _local.pid = os.getpid()
+    return _local.db
+
+def read_meta(url):
+    """
+    Returns the index entry of url as a dictionary, or None if not cached
+    """
+    cur = index().execute('SELECT * FROM entries WHERE key = ?', (cache_key(url),))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    meta = dict(zip([c[0] for c in cur.description], row))
+    if not os.path.isfile(entry_path(meta)):
+        # Removed behind our back
+        index().execute('DELETE FROM entries WHERE key = ?', (meta['key'],))
+        return None
+    return meta
+
+def write_meta(meta):
+    index().execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (meta['key'], meta['url'], meta['size'], meta['compressed'],
+                     meta['etag'], meta['last_modified'], meta['fetched'], time.time()))
+
+def touch(meta):
+    index().execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), meta['key']))
+
+def entry_path(meta):
+    fn = f"{CACHE_PATH}/{meta['key'][:2]}/{meta['key']}"
+    return f'{fn}.gz' if meta['compressed'] else fn
+
+def remove_entry(meta):
+    index().execute('DELETE FROM entries WHERE key = ?', (meta['key'],))
+    try:
+        os.unlink(entry_path(meta))
+    except FileNotFoundError:
+        pass
+
+def migrate_legacy(url):
+    """
+    Move an object cached by earlier versions (flat CACHE_PATH/<sha1>) into the store
+    """
+    key = cache_key(url)
+    legacy = f'{CACHE_PATH}/{key}'
+    if not os.path.isfile(legacy):
+        return None
+    meta = { 'key': key, 'url': url, 'size': os.path.getsize(legacy), 'compressed': 0,
+             'etag': None, 'last_modified': None, 'fetched': os.path.getmtime(legacy) }
+    os.makedirs(os.path.dirname(entry_path(meta)), exist_ok = True)
+    os.replace(legacy, entry_path(meta))
+    if os.path.exists(f'{legacy}.meta'):
+        os.unlink(f'{legacy}.meta')
+    write_meta(meta)
+    return meta
+
+def total_size():
+    return index().execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
 
-def open_url(url, mode='r', cached = True, update = False):
+def prune(max_bytes = None, keep = None):
+    """
+    Evict least recently accessed objects until the cache fits in max_bytes
+    (default: config.CACHE_MAX_BYTES). Returns the number of bytes freed.
+    keep: Key of an object not to evict
+    """
+    max_bytes = config.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    size = total_size()
+    freed = 0
+    if size <= max_bytes:
+        return 0
+    cur = index().execute('SELECT key, url, compressed, size FROM entries ORDER BY accessed')
+    for (key, url, compressed, entry_size) in cur.fetchall():
+        if size - freed <= max_bytes:
+            break
+        if key == keep:
+            continue
+        debug(f'Evicting {url}')
+        remove_entry({ 'key': key, 'compressed': compressed })
+        freed += entry_size
+    return freed
+
+def ttl_for(url):
+    """
+    Returns the time to live (seconds) for url from config.CACHE_TTL, None meaning forever
+    """
+    for (pattern, ttl) in config.CACHE_TTL:
+        if re.search(pattern, url):
+            return ttl
+    return None
+
+def is_stale(url, meta):
+    ttl = ttl_for(url)
+    if ttl is None:
+        return False
+    return time.time() - meta['fetched'] > ttl
+
+def read_part(part):
+    """
+    Returns (size, validator) of a partial download, or (0, None) if there is none
+    """
+    try:
+        with open(f'{part}.json') as f:
+            validator = json.load(f)['validator']
+        return (os.path.getsize(part), validator)
+    except (IOError, ValueError, KeyError):
+        return (0, None)
+
+def remove_part(part):
+    for fn in [part, f'{part}.json']:
+        if os.path.exists(fn):
+            os.unlink(fn)
+
+def download(url, fn, meta = None, compress = None):
+    """
+    Download url into fn (atomically). If meta (of the current cached object) is given,
+    the request is made conditional and meta is returned as is if the server says it is
+    not modified. Returns the new metadata for fn.
+    compress: Store gzip compressed as fn.gz (default: config.CACHE_COMPRESS for text content)
+    Uncompressed downloads are streamed into fn.part, which is kept if the transfer breaks
+    and resumed with a range request on the next attempt.
+    """
+    headers = {}
+    part = f'{fn}.part'
+    (offset, validator) = read_part(part) if not meta else (0, None)
+    if meta:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    elif offset and validator:
+        debug(f'Resuming {url} from {offset} bytes')
+        # Range must be in terms of the stored (identity) encoding
+        headers.update({ 'Range': f'bytes={offset}-', 'If-Range': validator, 'Accept-Encoding': 'identity' })
+    fetch.limiter.wait(url)
+    try:
+        f = httppool.pool.request(url, headers)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:
+            raise
+        # Partial download doesn't fit the current object, start over
+        remove_part(part)
+        return download(url, fn, meta, compress)
+    with f:
+        if f.status == 304:
+            debug(f'Not modified: {url}')
+            return { **meta, 'fetched': time.time() }
+        if compress is None:
+            compress = config.CACHE_COMPRESS and bool(COMPRESSIBLE.match(f.headers.get('Content-Type', '')))
+        if compress:
+            fn = f'{fn}.gz'
+            tmp = f'{fn}.tmp{os.getpid()}-{threading.get_ident()}'
+            out = gzip.open(tmp, mode='wb')
+        else:
+            tmp = part
+            if f.status == 206:
+                out = open(tmp, mode='ab')
+            else:
+                offset = 0
+                out = open(tmp, mode='wb')
+                validator = f.headers.get('ETag') or f.headers.get('Last-Modified')
+                if validator and not 'Content-Encoding' in f.headers:
+                    with open(f'{part}.json', 'w') as vf:
+                        json.dump({ 'validator': validator }, vf)
+        start = time.perf_counter()
+        try:
+            # we get a binary stream at this point, write it as such:
+            with out:
+                shutil.copyfileobj(f, out, config.CACHE_BUF_SIZE)
+            expected = f.headers.get('Content-Length')
+            if expected is not None and f.raw_bytes != int(expected):
+                raise http.client.IncompleteRead(b'', int(expected) - f.raw_bytes)
+            os.replace(tmp, fn)
+            remove_part(part)
+        except BaseException:
+            # Never leave partial files around to be mistaken for cached objects; partial
+            # uncompressed downloads are kept as .part to be resumed though
+            if tmp != part and os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        seconds = time.perf_counter() - start
+        if f.raw_bytes >= config.CACHE_BUF_SIZE:
+            debug(f'Downloaded {url}: {f.raw_bytes} bytes in {seconds:.1f}s '
+                  f'({f.raw_bytes / max(seconds, 1e-6) / 1e6:.1f} MB/s)')
+        return {
+            'key': cache_key(url),
+            'url': url,
+            'size': os.path.getsize(fn),
+            'compressed': int(compress),
+            'etag': f.headers.get('ETag'),
+            'last_modified': f.headers.get('Last-Modified'),
+            'fetched': time.time(),
+        }
+
+def open_entry(meta, mode):
+    if meta['compressed']:
+        return gzip.open(entry_path(meta), mode = mode if 'b' in mode else mode.replace('r', 'rt'))
+    return open(entry_path(meta), mode = mode)
+
+def store(url, meta = None):
+    """
+    Download url into the store (revalidating meta if given), evicting old objects if needed
+    """
+    fn = cached_name(url)
+    os.makedirs(os.path.dirname(fn), exist_ok = True)
+    new_meta = fetch.retrying(download, url, fn, meta)
+    if meta and new_meta['compressed'] != meta['compressed']:
+        # Stored under the other name previously
+        os.unlink(entry_path(meta))
+    write_meta(new_meta)
+    if new_meta is not meta and total_size() > config.CACHE_MAX_BYTES:
+        prune(keep = new_meta['key'])
+    return new_meta
+
+def open_url(url, mode='r', cached = True, update = None):
     """
     Returns a read handle for URL, either cached or not.
     mode: File mode, defaults to 'r', but 'rb' should be used on pure binary files.
     cached: Try to cache object / retrieve cached object if available (default = yes)
-    update: Validate cached object from server (if-modified-since) (default = no, unimplemented for now)
+    update: Revalidate cached object with the server (if-none-match / if-modified-since).
+            Default (None) revalidates objects older than their TTL in config.CACHE_TTL.
     """
-    cached_url = cached_name(url)
-    create_cachedir()
-    if not cached or not os.path.isfile(cached_url):
-        # Not in/from cache
+    if not cached:
+        # cached = False also implies no disk space wasted for url content
+        fn = f'{cached_name(url)}.uncached{os.getpid()}-{threading.get_ident()}'
+        os.makedirs(os.path.dirname(fn), exist_ok = True)
+        fetch.retrying(download, url, fn, None, False)
+        fh = open(fn, mode=mode)
+        os.unlink(fn)
+        return fh
+    meta = read_meta(url) or migrate_legacy(url)
+    if meta is None:
+        # Not in cache
         # The contents are always written to disk first; if url misbehaves this is were we fall
         # not at some random dataframe creation routine.
-        with urlreq.urlopen(url) as f:
-            # we get a binary stream at this point, write it as such:
-            with open(cached_url, mode='wb') as out:
-                while True:
-                    data = f.read(BUF_SIZE)
-                    out.write(data)
-                    if len(data) != BUF_SIZE:
-                        break
+        meta = store(url)
+    elif update or (update is None and is_stale(url, meta)):
+        debug(f'Revalidating cached {url}')
+        meta = store(url, meta)
     else:
         debug(f'Returning cached {url}')
-    fh = open(cached_url, mode=mode)
-    if not cached:
-        debug(f'Removing cached instance for {url}')
-        # cached = False also implies no disk space wasted for url content
-        os.unlink(cached_url)
-    return fh
+        touch(meta)
+    return open_entry(meta, mode)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Manage the URL cache')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    commands.add_parser('stats', help = 'show cache usage')
+    prune_parser = commands.add_parser('prune', help = 'evict least recently used objects')
+    prune_parser.add_argument('--max-bytes', type = int, default = None,
+                              help = f'size budget (default {config.CACHE_MAX_BYTES})')
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        (count, size, compressed) = index().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(compressed), 0) FROM entries').fetchone()
+        print(f'{count} objects ({compressed} compressed), {size} bytes of {config.CACHE_MAX_BYTES}')
+        hosts = {}
+        for (url, size) in index().execute('SELECT url, size FROM entries'):
+            host = re.sub(r'^\w+://([^/]+).*$', r'\1', url)
+            (n, total) = hosts.get(host, (0, 0))
+            hosts[host] = (n + 1, total + size)
+        for (host, (n, total)) in sorted(hosts.items()):
+            print(f'  {host}: {n} objects, {total} bytes')
+    elif args.command == 'prune':
+        print(f'Freed {prune(args.max_bytes)} bytes')
+
+if __name__ == '__main__':
+    main()
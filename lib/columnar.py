@@ -0,0 +1,182 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Column store layout (a directory per data frame):
+# - schema.json: column names, dtypes and the files holding them
+# - <kind>.npy:  all numeric columns of one dtype as a single (columns x rows) matrix,
+#                so that they can be handed to pandas as one block without copying
+# - c<n>.npy:    string (object) columns as fixed width unicode, with an optional
+#                c<n>.null.npy mask for missing (NaN) values. Columns holding anything
+#                else (numbers mixed with strings, None, lists..) are pickled as is.
+# - index.npy:   the index
+SCHEMA = 'schema.json'
+
+def _is_nan(v):
+    return isinstance(v, float) and v != v
+
+def _write_object(path, fn, values):
+    """
+    Returns how the values were stored: 'str', 'str+nulls' or 'pickle'
+    """
+    values = np.asarray(values, dtype = object)
+    if not all(isinstance(v, str) or _is_nan(v) for v in values):
+        np.save(f'{path}/{fn}.npy', values, allow_pickle = True)
+        return 'pickle'
+    nulls = np.array([ _is_nan(v) for v in values ], dtype = bool)
+    np.save(f'{path}/{fn}.npy', np.where(nulls, '', values).astype(str))
+    if nulls.any():
+        np.save(f'{path}/{fn}.null.npy', nulls)
+        return 'str+nulls'
+    return 'str'
+
+def _storage(entry):
+    # Stores written before 'storage' have a boolean 'nulls' (None for numeric index)
+    if 'storage' in entry:
+        return entry['storage']
+    return { None: None, False: 'str', True: 'str+nulls' }[entry['nulls']]
+
+def _read_object(path, fn, storage):
+    if storage == 'pickle':
+        return np.load(f'{path}/{fn}.npy', allow_pickle = True)
+    arr = np.load(f'{path}/{fn}.npy').astype(object)
+    if storage == 'str+nulls':
+        arr[np.load(f'{path}/{fn}.null.npy')] = np.nan
+    return arr
+
+def _write_files(df, path, source):
+    schema = {
+        'source': { 'size': source.st_size, 'mtime_ns': source.st_mtime_ns } if source else None,
+        'columns': list(df.columns),
+        'blocks': {},
+        'objects': [],
+    }
+    blocks = {}
+    for (n, name) in enumerate(df.columns):
+        col = df[name]
+        if col.dtype.kind in 'biuf':
+            blocks.setdefault(col.dtype.str, []).append(name)
+        else:
+            storage = _write_object(path, f'c{n}', col.astype(object).values)
+            # Extension types (category, string, datetime..) are restored from their name
+            dtype = None if col.dtype == object else col.dtype.name
+            schema['objects'].append({ 'name': name, 'file': f'c{n}', 'storage': storage, 'dtype': dtype })
+    for (i, (dtype, names)) in enumerate(blocks.items()):
+        np.save(f'{path}/b{i}.npy', df[names].values.T.astype(dtype))
+        schema['blocks'][f'b{i}'] = names
+    if df.index.dtype.kind in 'biuf':
+        np.save(f'{path}/index.npy', df.index.values)
+        schema['index'] = { 'name': df.index.name, 'storage': None }
+    else:
+        schema['index'] = { 'name': df.index.name, 'storage': _write_object(path, 'index', df.index.astype(object).values) }
+    with open(f'{path}/{SCHEMA}', 'w') as f:
+        json.dump(schema, f)
+
+def write(df, path, source = None):
+    """
+    Write df as a column store into directory path. The directory is replaced atomically.
+    Processes writing the same store at once each use a directory of their own.
+    source: Optional stat result of the file the data originated from, used by is_current.
+    """
+    (parent, name) = os.path.split(os.path.abspath(path))
+    tmp = tempfile.mkdtemp(prefix = f'{name}.', suffix = '.tmp', dir = parent)
+    try:
+        # Readable like any other directory (mkdtemp creates it private)
+        os.chmod(tmp, 0o755)
+        _write_files(df, tmp, source)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors = True)
+        raise
+    # Swap in the new store. Renaming a directory replaces an empty one.
+    old = tempfile.mkdtemp(prefix = f'{name}.', suffix = '.old', dir = parent)
+    try:
+        os.rename(path, old)
+    except FileNotFoundError:
+        pass
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another process got its store in between; keep that one
+        shutil.rmtree(tmp, ignore_errors = True)
+    shutil.rmtree(old, ignore_errors = True)
+
+def schema(path):
+    with open(f'{path}/{SCHEMA}') as f:
+        return json.load(f)
+
+def is_current(path, source_fn):
+    """
+    Is the column store at path up to date with regard to the file source_fn
+    """
+    try:
+        s = schema(path)
+    except (IOError, ValueError):
+        return False
+    try:
+        st = os.stat(source_fn)
+    except FileNotFoundError:
+        # Only the column store available
+        return True
+    return s['source'] == { 'size': st.st_size, 'mtime_ns': st.st_mtime_ns }
+
+def read(path, mmap = True):
+    """
+    Read a column store. Numeric columns are memory mapped copy-on-write (if mmap), so
+    that processes reading the same store share the pages through the OS page cache.
+    Columns are returned in the order they were written.
+    """
+    s = schema(path)
+    mode = 'c' if mmap else None
+    storage = _storage(s['index'])
+    if storage is None:
+        index = np.load(f'{path}/index.npy', mmap_mode = mode)
+    else:
+        index = _read_object(path, 'index', storage)
+    index = pd.Index(index, name = s['index']['name'])
+    # Pieces of the frame by column: numeric ones as views of their block
+    pieces = {}
+    for (fn, names) in s['blocks'].items():
+        block = np.load(f'{path}/{fn}.npy', mmap_mode = mode)
+        for (i, name) in enumerate(names):
+            pieces[name] = (block, i)
+    for col in s['objects']:
+        values = pd.Series(_read_object(path, col['file'], _storage(col)), index = index,
+                           name = col['name'], dtype = object)
+        if col.get('dtype'):
+            values = values.astype(col['dtype'])
+        pieces[col['name']] = values
+    # Stores written before 'columns' are grouped by type, numeric columns first
+    columns = s.get('columns', [ name for names in s['blocks'].values() for name in names ]
+                    + [ col['name'] for col in s['objects'] ])
+    # Consecutive columns of the same block stay one view, so nothing is copied
+    frames = []
+    run = None
+    for name in columns:
+        piece = pieces[name]
+        if isinstance(piece, tuple):
+            (block, i) = piece
+            if run and run[0] is block and run[2] == i:
+                run[2] += 1
+                run[3].append(name)
+                continue
+            if run:
+                frames.append(run)
+            run = [block, i, i + 1, [name]]
+        else:
+            if run:
+                frames.append(run)
+                run = None
+            frames.append(piece)
+    if run:
+        frames.append(run)
+    frames = [
+        pd.DataFrame(f[0][f[1]:f[2]].T, index = index, columns = f[3], copy = False)
+        if isinstance(f, list) else f.to_frame()
+        for f in frames
+    ]
+    if not frames:
+        return pd.DataFrame(index = index)
+    return pd.concat(frames, axis = 1, copy = False) if len(frames) > 1 else frames[0]
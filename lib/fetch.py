@@ -0,0 +1,73 @@
+import http.client
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from .debug import debug
+try:
+    from config import config
+except ModuleNotFoundError:
+    from ..config import config
+
+# HTTP errors worth retrying; anything else (e.g. 404) is final
+TRANSIENT_HTTP_ERRORS = [429, 500, 502, 503, 504]
+
+class HostLimiter:
+    """
+    Rate limiter spacing out the requests to each host by at least interval seconds.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+limiter = HostLimiter(config.FETCH_HOST_INTERVAL)
+
+def retrying(fn, *args, retries = None, backoff = None):
+    """
+    Call fn(*args), retrying on transient network errors with exponential backoff.
+    """
+    retries = config.FETCH_RETRIES if retries is None else retries
+    backoff = config.FETCH_BACKOFF if backoff is None else backoff
+    attempt = 0
+    while True:
+        try:
+            return fn(*args)
+        except urllib.error.HTTPError as e:
+            if not e.code in TRANSIENT_HTTP_ERRORS or attempt >= retries:
+                raise
+            err = e
+        except (urllib.error.URLError, http.client.HTTPException, ConnectionError, socket.timeout) as e:
+            if attempt >= retries:
+                raise
+            err = e
+        delay = backoff * 2 ** attempt
+        debug(f'Retrying in {delay:.1f}s after: {err}')
+        time.sleep(delay)
+        attempt += 1
+
+def parallel_map(fn, items, workers = None):
+    """
+    Run fn for all items in a thread pool of (at most) workers threads.
+    Generates (item, result, error) tuples in the order of items; error is the
+    exception raised by fn (result is then None) or None on success.
+    """
+    def call(item):
+        try:
+            return (item, fn(item), None)
+        except Exception as e:
+            return (item, None, e)
+    with ThreadPoolExecutor(workers or config.FETCH_WORKERS) as pool:
+        yield from pool.map(call, items)
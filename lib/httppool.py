@@ -0,0 +1,194 @@
+import http.client
+import threading
+import time
+import urllib.error
+import urllib.parse
+import zlib
+
+from .debug import debug
+try:
+    from config import config
+except ModuleNotFoundError:
+    from ..config import config
+
+class HostStats:
+    """
+    Request counters for a single host
+    """
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.bytes = 0     # As transferred, i.e. compressed
+        self.seconds = 0.0 # Request start until response fully read
+
+    def __repr__(self):
+        return (f'requests={self.requests} connections={self.connections} '
+                f'bytes={self.bytes} seconds={self.seconds:.2f}')
+
+class Response:
+    """
+    Readable response from ConnectionPool.request. Transparently decompresses gzip
+    transfer encoding and returns the connection to the pool once fully read.
+    """
+    def __init__(self, pool, key, conn, resp, url, start):
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+        self.raw_bytes = 0
+        self._complete = False
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._start = start
+        encoding = resp.getheader('Content-Encoding', '').lower()
+        self._decomp = zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding in ['gzip', 'x-gzip'] else None
+        if resp.length == 0:
+            # No body (304, 204, Content-Length: 0), nothing to read before reusing
+            # the connection; reading b'' lets http.client mark the response closed
+            resp.read()
+            self._complete = True
+
+    def read(self, n = -1):
+        """
+        Read (at most) n bytes, or everything if n < 0. Returns b'' only at end of data.
+        """
+        if self._resp is None:
+            return b''
+        if n < 0:
+            # Reads up to the end, raising IncompleteRead if the connection closes early
+            data = self._resp.read()
+            self.raw_bytes += len(data)
+            self._complete = True
+            self.close()
+            if self._decomp:
+                return self._decomp.decompress(data) + self._decomp.flush()
+            return data
+        while True:
+            data = self._resp.read(n)
+            self.raw_bytes += len(data)
+            if not data:
+                # http.client signals a connection closed before Content-Length
+                # only by leaving the remaining length set
+                missing = self._resp.length
+                self._complete = not missing
+                self.close()
+                if missing:
+                    raise http.client.IncompleteRead(b'', missing)
+                return self._decomp.flush() if self._decomp else b''
+            if self._decomp:
+                data = self._decomp.decompress(data)
+                if not data:
+                    # Only gzip header so far
+                    continue
+            return data
+
+    def close(self):
+        if self._resp is None:
+            return
+        # Only a fully read response leaves the connection in a usable state
+        reusable = self._complete and self._resp.isclosed() and not self._resp.will_close
+        if not reusable:
+            self._resp.close()
+        self._pool._release(self._key, self._conn, reusable,
+                            self.raw_bytes, time.perf_counter() - self._start)
+        self._resp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections, pooled per host.
+    """
+    def __init__(self, max_idle = None, timeout = None):
+        self.max_idle = config.HTTP_POOL_SIZE if max_idle is None else max_idle
+        self.timeout = config.HTTP_TIMEOUT if timeout is None else timeout
+        self._idle = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _host_stats(self, key):
+        if not key in self._stats:
+            self._stats[key] = HostStats()
+        return self._stats[key]
+
+    def _connect(self, key):
+        (scheme, netloc) = key
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        with self._lock:
+            self._host_stats(key).connections += 1
+        return cls(netloc, timeout = self.timeout)
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+        return (self._connect(key), False)
+
+    def _release(self, key, conn, reusable, nbytes, seconds):
+        with self._lock:
+            stats = self._host_stats(key)
+            stats.bytes += nbytes
+            stats.seconds += seconds
+            idle = self._idle.setdefault(key, [])
+            if reusable and len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url, headers = {}, redirects = 5):
+        """
+        GET url. Raises urllib.error.HTTPError for error statuses, like urlopen.
+        Informational statuses below 400 (e.g. 304, 206) are returned as is.
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += f'?{parts.query}'
+        headers = { 'Accept-Encoding': 'gzip', 'User-Agent': 'ids-project', **headers }
+        with self._lock:
+            self._host_stats(key).requests += 1
+        start = time.perf_counter()
+        (conn, reused) = self._acquire(key)
+        try:
+            conn.request('GET', path, headers = headers)
+            resp = conn.getresponse()
+        except (http.client.HTTPException, ConnectionError) as e:
+            conn.close()
+            if not reused:
+                raise
+            # Server closed the idle connection; try again on a fresh one
+            debug(f'Reconnecting to {parts.netloc}: {e!r}')
+            conn = self._connect(key)
+            conn.request('GET', path, headers = headers)
+            resp = conn.getresponse()
+        response = Response(self, key, conn, resp, url, start)
+        if resp.status in [301, 302, 303, 307, 308] and redirects > 0:
+            location = urllib.parse.urljoin(url, resp.getheader('Location'))
+            response.read()
+            return self.request(location, headers, redirects - 1)
+        if resp.status >= 400:
+            response.read()
+            raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+        return response
+
+    def stats(self):
+        """
+        Returns per host statistics as a dictionary netloc -> HostStats
+        """
+        with self._lock:
+            return { netloc: stats for ((_, netloc), stats) in self._stats.items() }
+
+    def log_stats(self):
+        for (netloc, stats) in self.stats().items():
+            debug(f'{netloc}: {stats}')
+
+# Shared pool for open_url
+pool = ConnectionPool()
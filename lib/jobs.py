@@ -0,0 +1,157 @@
+import os
+import time
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from .debug import debug
+try:
+    from config import config
+except ModuleNotFoundError:
+    from ..config import config
+
+def default_workers(memory_per_task = None):
+    """
+    Number of worker processes: one per cpu, but no more than fit in the currently
+    available memory when each task needs memory_per_task bytes.
+    """
+    workers = os.cpu_count() or 1
+    if memory_per_task:
+        try:
+            available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+            workers = min(workers, max(1, available // memory_per_task))
+        except (ValueError, OSError, AttributeError):
+            # Not available on this platform
+            pass
+    return workers
+
+# Seconds past the timeout before a task that ignores the alarm (stuck in C code)
+# has its worker killed
+KILL_GRACE = 5
+
+def _timeout(signum, frame):
+    raise TimeoutError('Task timed out')
+
+def _run(job):
+    """
+    Runs in the worker: call fn(task), returning errors instead of raising them so that
+    a failing task never takes the whole pool down.
+    """
+    (fn, i, task, timeout) = job
+    if timeout:
+        signal.signal(signal.SIGALRM, _timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return (i, True, fn(task))
+    except Exception as e:
+        # Exceptions aren't always picklable
+        return (i, False, f'{type(e).__name__}: {e}')
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+def _terminate(pool):
+    # ProcessPoolExecutor has no public way to stop its processes (before Python 3.14),
+    # _processes (pid -> Process) is private
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait = False, cancel_futures = True)
+
+def run_jobs(fn, tasks, on_result, workers = None, retries = None, timeout = None,
+             label = 'jobs', initializer = None, initargs = ()):
+    """
+    Run fn(task) for all tasks in a process pool. on_result(task, result) is called in this
+    process as soon as each task completes (in completion order).
+    workers: Pool size (default: one per cpu, see default_workers)
+    retries: Times a failed task is retried (default: config.JOB_RETRIES)
+    timeout: Seconds a single task may take. Pure Python code is interrupted, a task
+             stuck in C code has its worker killed KILL_GRACE seconds later.
+    A worker that dies (e.g. killed for running out of memory) fails its task; the other
+    tasks running at the time are run again, one at a time, to find out which one it was.
+    Returns a list of (task, error) for the tasks that still failed after the retries.
+    """
+    retries = config.JOB_RETRIES if retries is None else retries
+    tasks = list(tasks)
+    total = len(tasks)
+    if not total:
+        return []
+    workers = min(workers or default_workers(), total)
+    queue = deque(range(total))
+    # Tasks that were running when a worker died, run alone until they pass
+    suspects = set()
+    attempts = [0] * total
+    errors = {}
+    done = 0
+    start = time.perf_counter()
+
+    def fail(i, error):
+        attempts[i] += 1
+        debug(f'{label}: task {i} failed (attempt {attempts[i]}): {error}')
+        if attempts[i] <= retries:
+            queue.append(i)
+        else:
+            errors[i] = error
+
+    pool = None
+    running = {} # future -> (task index, start time)
+    try:
+        while queue or running:
+            if pool is None:
+                pool = ProcessPoolExecutor(workers, initializer = initializer, initargs = initargs)
+            # No more tasks than workers, so that tasks start when submitted
+            while queue and len(running) < workers:
+                if (queue[0] in suspects and running) or any(i in suspects for (i, _) in running.values()):
+                    break
+                i = queue.popleft()
+                running[pool.submit(_run, (fn, i, tasks[i], timeout))] = (i, time.monotonic())
+            deadline = None
+            if timeout:
+                deadline = min(started for (_, started) in running.values()) + timeout + KILL_GRACE
+            (finished, _) = wait(running, None if deadline is None else max(deadline - time.monotonic(), 0),
+                                 return_when = FIRST_COMPLETED)
+            broken = False
+            for future in finished:
+                try:
+                    (i, ok, result) = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    continue
+                del running[future]
+                suspects.discard(i)
+                if ok:
+                    done += 1
+                    on_result(tasks[i], result)
+                    elapsed = time.perf_counter() - start
+                    debug(f'{label}: {done}/{total} done ({done / elapsed:.2f}/s)')
+                else:
+                    fail(i, result)
+            if broken:
+                if len(running) == 1:
+                    (i, _) = running.popitem()[1]
+                    fail(i, 'Worker process died')
+                else:
+                    suspects.update(i for (i, _) in running.values())
+            elif not finished:
+                # Timed out in C code, the worker can only be killed
+                now = time.monotonic()
+                for (future, (i, started)) in list(running.items()):
+                    if now - started >= timeout + KILL_GRACE:
+                        del running[future]
+                        fail(i, 'TimeoutError: Task timed out')
+                broken = True
+            if broken:
+                # Tasks still running start over in a new pool
+                queue.extendleft(i for (i, _) in running.values())
+                running = {}
+                _terminate(pool)
+                pool = None
+    except BaseException:
+        if pool is not None:
+            _terminate(pool)
+        raise
+    if pool is not None:
+        pool.shutdown()
+    if errors:
+        debug(f'{label}: {len(errors)} of {total} tasks failed')
+    return [ (tasks[i], error) for (i, error) in sorted(errors.items()) ]
@@ -0,0 +1,42 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache for bytes-like values, bounded both by
+    entry count and the total size of the stored values.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._d = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._d)
+
+    def get(self, key):
+        with self._lock:
+            if not key in self._d:
+                return None
+            self._d.move_to_end(key)
+            return self._d[key]
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            # Would flush the whole cache, don't bother
+            return
+        with self._lock:
+            if key in self._d:
+                self.size -= len(self._d.pop(key))
+            self._d[key] = value
+            self.size += len(value)
+            while len(self._d) > self.max_entries or self.size > self.max_bytes:
+                (_, old) = self._d.popitem(last = False)
+                self.size -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+            self.size = 0
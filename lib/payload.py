@@ -0,0 +1,37 @@
+import gzip
+import hashlib
+
+try:
+    import brotli
+except ModuleNotFoundError:
+    # Optional, gzip is always available
+    brotli = None
+
+class Payload:
+    """
+    A response body encoded once: as is, gzip and (if the brotli module is available)
+    brotli compressed, with ETags derived from the content. Each encoding has its own
+    ETag (<digest>-<encoding>), as the variants differ byte for byte.
+    usage:
+    - payload = Payload(json_str.encode())
+    - (encoding, body, etag) = payload.select(request.accept_encodings)
+    """
+    def __init__(self, body):
+        self.digest = hashlib.sha1(body).hexdigest()[:20]
+        self.variants = { 'identity': body, 'gzip': gzip.compress(body, 9) }
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body)
+
+    def etag(self, encoding):
+        return self.digest if encoding == 'identity' else f'{self.digest}-{encoding}'
+
+    def select(self, accept_encodings):
+        """
+        Returns (encoding, body, etag) of the smallest variant acceptable to the client.
+        accept_encodings: Quality lookup of the client's Accept-Encoding header,
+                          e.g. werkzeug's request.accept_encodings
+        """
+        accepted = [ (len(body), encoding) for (encoding, body) in self.variants.items()
+                     if encoding == 'identity' or accept_encodings[encoding] > 0 ]
+        (_, encoding) = min(accepted)
+        return (encoding, self.variants[encoding], self.etag(encoding))
@@ -0,0 +1,91 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS = 6371.0 # km
+# Map tiles are this many pixels wide at every zoom level
+TILE_SIZE = 256
+
+def unit_vectors(lat, lng):
+    """
+    Points on the unit sphere, as an N x 3 array
+    """
+    (lat, lng) = (np.radians(lat), np.radians(lng))
+    return np.column_stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)])
+
+def mercator(lat, lng):
+    """
+    Web Mercator coordinates scaled to 0..1 (the whole world at zoom level 0)
+    """
+    x = (np.asarray(lng, dtype = float) + 180) / 360
+    y = (1 - np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) / np.pi) / 2
+    return (x, y)
+
+class SpatialIndex:
+    """
+    Index of points (latitude, longitude) for bounding box, nearest neighbour and
+    clustering queries. Queries return positions of the points as given.
+    usage:
+    - index = SpatialIndex(df.latitude.values, df.longitude.values)
+    - df.iloc[index.bbox(24.9, 60.1, 25.0, 60.2)]
+    """
+    def __init__(self, lat, lng):
+        self.lat = np.asarray(lat, dtype = float)
+        self.lng = np.asarray(lng, dtype = float)
+        # Latitude sorted, so a bounding box is a contiguous range filtered by longitude
+        self._order = np.argsort(self.lat, kind = 'mergesort')
+        self._sorted_lat = self.lat[self._order]
+        # Chord distance on the unit sphere orders points like great circle distance
+        self._tree = cKDTree(unit_vectors(self.lat, self.lng))
+        (self._x, self._y) = mercator(self.lat, self.lng)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def bbox(self, west, south, east, north):
+        """
+        Positions of points within the bounding box (edges included), in index order
+        """
+        start = np.searchsorted(self._sorted_lat, south, side = 'left')
+        stop = np.searchsorted(self._sorted_lat, north, side = 'right')
+        candidates = self._order[start:stop]
+        lng = self.lng[candidates]
+        if west <= east:
+            inside = (lng >= west) & (lng <= east)
+        else:
+            # Box crosses the antimeridian
+            inside = (lng >= west) | (lng <= east)
+        return np.sort(candidates[inside])
+
+    def nearest(self, lat, lng, n = 1):
+        """
+        Positions of the n points nearest to (lat, lng) and their distances in km,
+        nearest first.
+        """
+        n = min(n, len(self))
+        if n <= 0:
+            return (np.array([], dtype = int), np.array([]))
+        (chord, positions) = self._tree.query(unit_vectors([lat], [lng])[0], k = n)
+        (chord, positions) = (np.atleast_1d(chord), np.atleast_1d(positions))
+        distance = 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
+        return (positions, distance)
+
+    def clusters(self, west, south, east, north, zoom, cell_size = 64):
+        """
+        Cluster the points within the bounding box on a grid of cell_size pixel squares
+        at map zoom level zoom.
+        Returns (latitude, longitude, count, position) arrays, one element per cluster:
+        the mean location, number of points, and the position of the point for clusters
+        of a single point (-1 otherwise).
+        """
+        positions = self.bbox(west, south, east, north)
+        cells = TILE_SIZE * 2 ** zoom / cell_size
+        col = np.floor(self._x[positions] * cells).astype(np.int64)
+        row = np.floor(self._y[positions] * cells).astype(np.int64)
+        (keys, inverse) = np.unique(row * (int(cells) + 1) + col, return_inverse = True)
+        count = np.bincount(inverse, minlength = len(keys))
+        lat = np.bincount(inverse, weights = self.lat[positions], minlength = len(keys)) / np.maximum(count, 1)
+        lng = np.bincount(inverse, weights = self.lng[positions], minlength = len(keys)) / np.maximum(count, 1)
+        single = np.full(len(keys), -1)
+        single[inverse] = positions
+        single[count > 1] = -1
+        return (lat, lng, count, single)
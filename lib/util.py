@@ -1,3 +1,5 @@
+import numpy as np
+
 def month_range(start, stop):
     """
     Generator for ISO-style (YYYY-MM-dd) dates in inclusive range start,stop
@@ -24,3 +26,15 @@ def month_range(start, stop):
             year += 1
 
 
+
+def month_periods(dates):
+    """
+    Integer month periods (months since 1970-01) of dates, as a NumPy array
+    """
+    return np.asarray(dates, dtype = 'datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+
+def period_dates(periods):
+    """
+    List of ISO-style dates (first day of month) of integer month periods, see month_periods
+    """
+    return np.asarray(periods, dtype = np.int64).astype('datetime64[M]').astype('datetime64[D]').astype(str).tolist()
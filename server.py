@@ -1,38 +1,208 @@
-from flask import Flask, Response, abort, send_file
-import io
+from flask import Flask, Response, abort, request, send_file
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing as mp
+import threading
+import json
+import math
+import time
+import os
 
 import graphics
-from data.wrangler import get_data
-from data.energy import make_prognosis
+from config import config
+from data.wrangler import chart_path
+from data.datastore import DatastoreManager
 
 app = Flask(__name__, static_folder = 'build/static')
 
 print('Reading properties ...')
-df_buildings = get_data('heated_buildings').or_fail()
-df_temperatures = get_data('decade_temperatures').or_fail()
-df_avgtemp = get_data('avg_temperatures').or_fail()
-df_anomalities = get_data('seasonal_anomalities').or_fail()
+# Requests take datastore.current once, it is replaced whenever fetch_data.py refreshes the store
+datastore = DatastoreManager()
+if config.DATASTORE_WATCH:
+    datastore.start()
+
+# Chart rendering processes, created on first use in each server process
+render_pool = None
+render_pool_pid = None
+render_lock = threading.Lock()
+# Renders running at once on the host. Created before gunicorn forks (preload_app),
+# so that all server processes share it; each process' pool only starts processes
+# as needed.
+render_slots = mp.BoundedSemaphore(config.RENDER_WORKERS)
+# Request threads of this server process that may wait for a render; the rest are
+# kept for the requests that don't render (copied as is into each forked process)
+render_waiters = threading.BoundedSemaphore(config.RENDER_WAITERS)
+
+def get_render_pool():
+    global render_pool, render_pool_pid
+    with render_lock:
+        if render_pool is None or render_pool_pid != os.getpid():
+            # Pools don't survive forking, and forking a threaded server is unsafe
+            render_pool = ProcessPoolExecutor(config.RENDER_WORKERS, mp.get_context('forkserver'))
+            render_pool_pid = os.getpid()
+        return render_pool
+
+def recycle_render_pool(pool):
+    """
+    Stop the processes of pool, the next request starts a new one. A render that
+    timed out can't be cancelled otherwise. Other renders of the pool fail.
+    """
+    global render_pool
+    with render_lock:
+        if render_pool is pool:
+            render_pool = None
+    # ProcessPoolExecutor has no public way to stop its processes (before Python 3.14),
+    # _processes (pid -> Process) is private
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait = False)
+
+def render_chart(snapshot, building):
+    """
+    Render the energy history chart of building in the render pool, so that slow
+    renders only hold up the requests waiting for them.
+    """
+    # Busy rendering already, don't tie up another request thread
+    if not render_waiters.acquire(blocking = False):
+        abort(503)
+    try:
+        return render_in_pool(snapshot, building)
+    finally:
+        render_waiters.release()
+
+def render_in_pool(snapshot, building):
+    deadline = time.monotonic() + config.RENDER_TIMEOUT
+    if not render_slots.acquire(timeout = config.RENDER_TIMEOUT):
+        abort(503)
+    try:
+        pool = get_render_pool()
+        future = pool.submit(graphics.render_energy_temperature_history,
+                             snapshot.heat_series.for_building(building), snapshot.temperatures,
+                             snapshot.prognoses.for_building(building))
+        return future.result(timeout = max(deadline - time.monotonic(), 0))
+    except (TimeoutError, BrokenProcessPool):
+        # Hung or died; start over with a new pool on the next request
+        recycle_render_pool(pool)
+        abort(503)
+    finally:
+        render_slots.release()
+
+def read_prerendered(building):
+    try:
+        with open(chart_path(building), 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+def png_response(png, etag):
+    response = Response(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = config.PNG_MAX_AGE
+    return response
 
 @app.route('/api/properties')
 def properties():
-    return Response(
-        df_buildings[['propertyName', 'latitude', 'longitude']].to_json(orient='index'),
-        mimetype='application/json')
+    payload = datastore.current.properties_payload
+    (encoding, body, etag) = payload.select(request.accept_encodings)
+    if etag in request.if_none_match:
+        response = Response(status = 304)
+    else:
+        response = Response(body, mimetype='application/json')
+        if encoding != 'identity':
+            response.content_encoding = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = config.PROPERTIES_MAX_AGE
+    return response
+
+def json_response(body):
+    return Response(body, mimetype='application/json')
+
+def valid_latlng(lat, lng):
+    return (math.isfinite(lat) and math.isfinite(lng)
+            and -90 <= lat <= 90 and -180 <= lng <= 180)
+
+def bbox_arg():
+    """
+    The bbox query argument: west,south,east,north (as Leaflet's LatLngBounds.toBBoxString)
+    """
+    try:
+        (west, south, east, north) = map(float, request.args['bbox'].split(','))
+    except (KeyError, ValueError):
+        abort(400)
+    if not (valid_latlng(south, west) and valid_latlng(north, east) and south <= north):
+        abort(400)
+    return (west, south, east, north)
+
+@app.route('/api/properties/bbox')
+def properties_in_bbox():
+    """
+    Buildings within ?bbox=, in the same format as /api/properties
+    """
+    snapshot = datastore.current
+    positions = snapshot.spatial_index.bbox(*bbox_arg())
+    (codes, property_json) = (snapshot.buildings.index, snapshot.property_json)
+    return json_response('{' + ','.join(f'{json.dumps(codes[i])}:{property_json[i]}' for i in positions) + '}')
+
+@app.route('/api/properties/nearest')
+def nearest_properties():
+    """
+    The ?n= (default 1) buildings nearest to ?lat=&lng=, nearest first, with distance in km
+    """
+    lat = request.args.get('lat', type = float)
+    lng = request.args.get('lng', type = float)
+    n = request.args.get('n', 1, type = int)
+    if lat is None or lng is None or n is None or not valid_latlng(lat, lng) or n < 1:
+        abort(400)
+    snapshot = datastore.current
+    (positions, distances) = snapshot.spatial_index.nearest(lat, lng, min(n, config.NEAREST_MAX))
+    buildings = snapshot.buildings.iloc[positions]
+    return json_response(json.dumps([
+        { 'buildingCode': code, 'propertyName': name, 'latitude': la, 'longitude': ln, 'distance': d }
+        for (code, name, la, ln, d) in zip(buildings.index, buildings.propertyName,
+                                           buildings.latitude, buildings.longitude, distances)
+    ]))
+
+@app.route('/api/properties/clusters')
+def property_clusters():
+    """
+    Buildings within ?bbox= clustered for map ?zoom= level. Clusters of a single
+    building include its buildingCode.
+    """
+    zoom = request.args.get('zoom', type = int)
+    if zoom is None or not 0 <= zoom <= 30:
+        abort(400)
+    snapshot = datastore.current
+    (lat, lng, count, single) = snapshot.spatial_index.clusters(*bbox_arg(), zoom, config.CLUSTER_CELL_SIZE)
+    codes = snapshot.buildings.index
+    clusters = [
+        { 'latitude': la, 'longitude': ln, 'count': int(c), **({ 'buildingCode': codes[i] } if i >= 0 else {}) }
+        for (la, ln, c, i) in zip(lat, lng, count, single)
+    ]
+    return json_response(json.dumps(clusters))
 
 @app.route('/api/properties/<building>/energy_history')
 def energy_history(building):
-    if not building in df_buildings.index:
+    snapshot = datastore.current
+    if not building in snapshot.prognoses:
         abort(404)
-    row = df_buildings.loc[building]
-    prognosis = make_prognosis(row, df_avgtemp, df_anomalities)
-    # Store image in memory
-    buf = io.BytesIO()
-    graphics.plot_energy_temperature_history(row, df_temperatures, prognosis, buf)
-    buf.seek(0)
-    return send_file(buf, mimetype='image/png')
+    etag = f'{building}-{snapshot.fingerprint}'
+    if etag in request.if_none_match:
+        # Client already has it, skip rendering altogether
+        response = png_response(b'', etag)
+        response.status_code = 304
+        return response
+    png = snapshot.png_cache.get(etag)
+    if png is None and building in snapshot.prerendered:
+        png = read_prerendered(building)
+    if png is None:
+        png = render_chart(snapshot, building)
+        snapshot.png_cache.put(etag, png)
+    return png_response(png, etag)
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def catch_all(path):
     return send_file('build/index.html')
-
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# IDS Project 2020
+# Compare serving the full property list to spatial index queries
+
+import time
+import json
+import numpy as np
+import pandas as pd
+
+from lib.spatial import SpatialIndex
+
+def benchmark(n = 100000, seed = 0):
+    """
+    Compare serving the full property list to index queries on a synthetic catalogue
+    of n buildings around Helsinki.
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'propertyName': [ f'Property {i}' for i in range(n) ],
+        'latitude': rng.normal(60.2, 0.08, n),
+        'longitude': rng.normal(24.95, 0.15, n),
+    }, index = [ f'{i:09d}' for i in range(n) ])
+
+    def timed(label, fn, repeat = 5):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = fn()
+        ms = (time.perf_counter() - start) / repeat * 1000
+        size = f', {len(result) / 1024:.0f} KiB' if isinstance(result, (str, bytes)) else ''
+        print(f'{label:40s} {ms:8.2f} ms{size}')
+        return result
+
+    timed('Full list to_json', lambda: df.to_json(orient = 'index'))
+    index = timed('Build index', lambda: SpatialIndex(df.latitude.values, df.longitude.values), 1)
+    fragments = timed('Pre-serialize buildings', lambda: [
+        f'{json.dumps(code)}:{json.dumps(dict(propertyName = name, latitude = lat, longitude = lng))}'
+        for (code, name, lat, lng) in zip(df.index, df.propertyName, df.latitude, df.longitude) ], 1)
+    # Roughly a city district at zoom level 15
+    view = (24.93, 60.16, 24.97, 60.18)
+    positions = timed('bbox query', lambda: index.bbox(*view))
+    timed(f'bbox response ({len(positions)} buildings)',
+          lambda: '{' + ','.join(fragments[i] for i in index.bbox(*view)) + '}')
+    timed('nearest 10', lambda: index.nearest(60.17, 24.94, 10))
+    for zoom in [10, 13, 16]:
+        (_, _, count, _) = timed(f'clusters, whole area, zoom {zoom}',
+                                 lambda: index.clusters(23, 59, 27, 61, zoom))
+        print(f'{"":40s} {len(count)} clusters')
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import threading
+import unittest
+import numpy as np
+import pandas as pd
+
+from lib import columnar
+
+class ColumnarTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = f'{self.dir.name}/store'
+        self.df = pd.DataFrame({
+            'name': np.array(['a', np.nan, 'c'], dtype = object),
+            'value': [1.0, 2.0, 3.0],
+            'mixed': np.array([1, 'b', None], dtype = object),
+            'count': [1, 2, 3],
+        }, index = pd.Index(['x', 'y', 'z'], name = 'key'))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip_keeps_columns_and_values(self):
+        columnar.write(self.df, self.path)
+        df = columnar.read(self.path)
+        self.assertEqual(list(df.columns), list(self.df.columns))
+        self.assertEqual(list(df.index), list(self.df.index))
+        self.assertEqual(list(df['mixed']), [1, 'b', None])
+        self.assertTrue(np.isnan(df['name'].iloc[1]))
+        np.testing.assert_array_equal(df['value'].values, self.df['value'].values)
+
+    def test_concurrent_writers(self):
+        errors = []
+        def write():
+            try:
+                for _ in range(10):
+                    columnar.write(self.df, self.path)
+            except Exception as e:
+                errors.append(e)
+        threads = [ threading.Thread(target = write) for _ in range(4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.dir.name), ['store'])
+        self.assertEqual(list(columnar.read(self.path).columns), list(self.df.columns))
+
+if __name__ == '__main__':
+    unittest.main()
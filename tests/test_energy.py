@@ -0,0 +1,41 @@
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+import data.energy as energy
+from data.energy import Prognoses, energy_jobs, energy_series_table, get_energy_series
+
+MONTHS = [ f'month{n}' for n in range(7) ]
+
+class PrognosesTest(unittest.TestCase):
+    def test_uses_latest_report(self):
+        avg = pd.DataFrame({ 'avg_temp': np.arange(1, 13, dtype = float) }, index = range(1, 13))
+        anomalities = pd.DataFrame([[1.0] * 7, [2.0] * 7], columns = MONTHS,
+                                   index = pd.Index(['2020-09-01', '2020-10-01'], name = 'date'))
+        buildings = pd.DataFrame({ 'lin_coef': [-1.0], 'lin_intercept': [20.0], 'lin_score': [1.0],
+                                   'log_coef': [0.0], 'log_intercept': [0.0], 'log_score': [0.0] },
+                                 index = ['B'])
+        df = Prognoses(buildings, avg, anomalities).for_building('B')
+        self.assertEqual(df.index[0], '2020-10-01')
+        # October 10 + 2 degrees, the linear model gives 20 - 12
+        self.assertEqual(df.heating.iloc[0], 8.0)
+
+def months(*ms):
+    return np.array(ms, dtype = 'datetime64[M]').astype(np.int64)
+
+class EnergySeriesTest(unittest.TestCase):
+    def test_closed_years_in_one_request(self):
+        self.assertEqual(energy_jobs('B', 'Heat', 2010, 2020),
+                         [('B', 'Heat', 2010, 2018), ('B', 'Heat', 2019, 2019), ('B', 'Heat', 2020, 2020)])
+        self.assertEqual(energy_jobs('B', 'Heat', 2020, 2020), [('B', 'Heat', 2020, 2020)])
+
+    def test_missing_value_keeps_stored_month(self):
+        previous = energy_series_table(['B', 'B'], ['Heat', 'Heat'], months('2020-01', '2020-02'), [10.0, 20.0])
+        fetched = (months('2020-01', '2020-02', '2020-03'), np.array([11.0, np.nan, 30.0]))
+        with mock.patch.object(energy, 'fetch_energy_years', lambda job: fetched):
+            df = get_energy_series(['B'], ['Heat'], previous)
+        self.assertEqual(list(df.value), [11.0, 20.0, 30.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import gzip
+import http.server
+import threading
+import unittest
+import urllib.error
+
+from lib.httppool import ConnectionPool
+
+BODY = b'temperature,anomaly\n' * 1000
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive
+    connections = set()
+
+    def do_GET(self):
+        Handler.connections.add(self.client_address)
+        if self.path == '/missing':
+            body = b'not found'
+            self.send_response(404)
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        else:
+            self.send_response(200)
+            body = BODY
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ConnectionPoolTest(unittest.TestCase):
+    """
+    ConnectionPool against a local stand-in server
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target = cls.server.serve_forever, daemon = True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        Handler.connections = set()
+        self.pool = ConnectionPool(max_idle = 2, timeout = 5)
+
+    def test_gzip_is_decoded(self):
+        with self.pool.request(f'{self.url}/data') as r:
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(r.read(), BODY)
+            self.assertLess(r.raw_bytes, len(BODY))
+
+    def test_connection_is_reused(self):
+        for _ in range(5):
+            with self.pool.request(f'{self.url}/data') as r:
+                self.assertEqual(r.read(), BODY)
+        stats = self.pool.stats()[self.url[len('http://'):]]
+        self.assertEqual(stats.requests, 5)
+        self.assertEqual(stats.connections, 1)
+        self.assertEqual(len(Handler.connections), 1)
+
+    def test_not_found_raises_http_error(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.pool.request(f'{self.url}/missing')
+        self.assertEqual(cm.exception.code, 404)
+        # The error body was read, so the connection is still usable
+        with self.pool.request(f'{self.url}/data') as r:
+            self.assertEqual(r.read(), BODY)
+        self.assertEqual(self.pool.stats()[self.url[len('http://'):]].connections, 1)
+
+    def test_not_modified_keeps_connection(self):
+        for _ in range(3):
+            with self.pool.request(f'{self.url}/data', { 'If-None-Match': '"v1"' }) as r:
+                self.assertEqual(r.status, 304)
+        self.assertEqual(self.pool.stats()[self.url[len('http://'):]].connections, 1)
+
+if __name__ == '__main__':
+    unittest.main()
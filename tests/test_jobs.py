@@ -0,0 +1,50 @@
+import os
+import signal
+import time
+import unittest
+from unittest import mock
+
+import lib.jobs
+from lib.jobs import run_jobs
+
+def work(task):
+    if task == 'die':
+        os._exit(1)
+    if task == 'stuck':
+        # Like C code, which the alarm can't interrupt
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+        time.sleep(30)
+    if task == 'slow':
+        time.sleep(30)
+    if task == 'fail':
+        raise ValueError('bad task')
+    return task * 2
+
+class RunJobsTest(unittest.TestCase):
+    def run_tasks(self, tasks, **kw):
+        results = {}
+        failures = run_jobs(work, tasks, lambda task, result: results.__setitem__(task, result),
+                            workers = 2, retries = 1, **kw)
+        return (results, dict(failures))
+
+    def test_results_and_failures(self):
+        (results, failures) = self.run_tasks([1, 2, 'fail', 3])
+        self.assertEqual(results, { 1: 2, 2: 4, 3: 6 })
+        self.assertEqual(list(failures), ['fail'])
+        self.assertIn('ValueError', failures['fail'])
+
+    def test_dead_worker_fails_its_task_only(self):
+        (results, failures) = self.run_tasks([1, 'die', 2, 3, 4])
+        self.assertEqual(results, { 1: 2, 2: 4, 3: 6, 4: 8 })
+        self.assertEqual(list(failures), ['die'])
+
+    def test_timeout(self):
+        start = time.monotonic()
+        with mock.patch.object(lib.jobs, 'KILL_GRACE', 0.5):
+            (results, failures) = self.run_tasks(['slow', 'stuck', 1], timeout = 0.5)
+        self.assertEqual(results, { 1: 2 })
+        self.assertEqual(sorted(failures), ['slow', 'stuck'])
+        self.assertLess(time.monotonic() - start, 29)
+
+if __name__ == '__main__':
+    unittest.main()
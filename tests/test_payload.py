@@ -0,0 +1,27 @@
+import gzip
+import unittest
+
+from lib.payload import Payload
+
+class Accept(dict):
+    # Like werkzeug's request.accept_encodings: unlisted encodings have quality 0
+    def __missing__(self, key):
+        return 0
+
+class PayloadTest(unittest.TestCase):
+    def setUp(self):
+        self.payload = Payload(b'{"a":"' + b'x' * 1000 + b'"}')
+
+    def test_identity_without_accept_encoding(self):
+        (encoding, body, etag) = self.payload.select(Accept())
+        self.assertEqual((encoding, body), ('identity', self.payload.variants['identity']))
+        self.assertEqual(etag, self.payload.digest)
+
+    def test_each_encoding_has_its_own_etag(self):
+        (encoding, body, etag) = self.payload.select(Accept(gzip = 1))
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(gzip.decompress(body), self.payload.variants['identity'])
+        self.assertEqual(etag, f'{self.payload.digest}-gzip')
+
+if __name__ == '__main__':
+    unittest.main()
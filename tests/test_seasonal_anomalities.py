@@ -0,0 +1,57 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+import data.seasonal_anomalities as seasonal_anomalities
+from data.seasonal_anomalities import MapSample, sample_image
+from lib.cache import cached_name
+
+POINTS = [(10, 20)]
+NAME = 'seasonal_sample:image.png:1:10,20'
+
+class SampleImageTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+        self.sample = MapSample(np.zeros((3, 3), dtype = np.uint8),
+                                { POINTS[0]: np.ones((3, 3, 3), dtype = np.uint8) }, 1)
+        self.decoded = 0
+        def decode(f, points, radius):
+            self.decoded += 1
+            return self.sample
+        patches = [
+            mock.patch.object(seasonal_anomalities, 'open_url', lambda *args: contextlib.nullcontext(io.BytesIO())),
+            mock.patch.object(MapSample, 'decode', staticmethod(decode)),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.dir.cleanup()
+
+    def test_sample_is_cached(self):
+        sample_image('image.png', POINTS, 1)
+        sample = sample_image('image.png', POINTS, 1)
+        self.assertEqual(self.decoded, 1)
+        np.testing.assert_array_equal(sample.windows[POINTS[0]], self.sample.windows[POINTS[0]])
+        self.assertEqual(os.listdir(os.path.dirname(cached_name(NAME))), [os.path.basename(cached_name(NAME))])
+
+    def test_truncated_sample_is_a_miss(self):
+        sample_image('image.png', POINTS, 1)
+        with open(cached_name(NAME), 'r+b') as f:
+            f.truncate(20)
+        sample_image('image.png', POINTS, 1)
+        self.assertEqual(self.decoded, 2)
+        # Stored again in full
+        sample_image('image.png', POINTS, 1)
+        self.assertEqual(self.decoded, 2)
+
+if __name__ == '__main__':
+    unittest.main()
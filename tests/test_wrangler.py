@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+import data.wrangler as wrangler
+from data.wrangler import get_data
+
+class GetDataTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+        os.mkdir(wrangler.DATA_STORE)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.dir.cleanup()
+
+    def test_column_store_reads_like_csv(self):
+        df = pd.DataFrame({
+            'avg_temp': [-3.5, -4.0, 1.25],
+            'label': pd.Categorical(['a', 'b', 'a']),
+        }, index = pd.date_range('2020-01-01', periods = 3, freq = 'MS', name = 'date'))
+        get_data('decade_temperatures').store(df)
+        self.assertTrue(wrangler.columnar.is_current(get_data('decade_temperatures').columnar,
+                                                     get_data('decade_temperatures').fn))
+        stored = get_data('decade_temperatures').or_fail()
+        csv = pd.read_csv(get_data('decade_temperatures').fn, index_col = 0)
+        self.assertEqual(list(stored.index), list(csv.index))
+        self.assertIsInstance(stored.index[0], str)
+        self.assertEqual(list(stored.columns), list(csv.columns))
+        self.assertEqual(list(stored.label), list(csv.label))
+        np.testing.assert_array_equal(stored.avg_temp.values, csv.avg_temp.values)
+
+if __name__ == '__main__':
+    unittest.main()